@@ -7,6 +7,10 @@ ITEMS_TO_PROCESS = "data/input/items_to_process.xls"
 KMLS_IN = "data/input/kmls"
 KMLS_OUT = "data/output/kmls"
 GEOJSON = "data/output/viewcones.geojson"
+JOURNAL = "data/output/journal.jsonl"
+RETRY_QUEUE = "data/output/retry.json"
+INVENTORY = os.getenv("INVENTORY", "data/cache/inventory.parquet")
+COLLECTIONS_CACHE = os.getenv("COLLECTIONS_CACHE", "data/cache/collections")
 CLOUDFRONT = "https://iiif.imaginerio.org/iiif"
 BUCKET = "https://imaginerio-images.s3.us-east-1.amazonaws.com/"
 DISTRIBUTION_ID = os.getenv("DISTRIBUTION_ID")
@@ -15,6 +19,66 @@ ARCGIS_PASSWORD = os.getenv("ARCGIS_PASSWORD")
 ARCGIS_PORTAL = os.getenv("ARCGIS_PORTAL")
 VIEWCONES_LAYER_URL = os.getenv("VIEWCONES_LAYER_URL")
 RETILE = os.getenv("RETILE", False)
+REBUILD = os.getenv("REBUILD", False)
+REBUILD_WORKERS = int(os.getenv("REBUILD_WORKERS", os.cpu_count()))
+SHARD_SIZE = int(os.getenv("SHARD_SIZE", 100))
+PUBLISH_CONCURRENCY = int(os.getenv("PUBLISH_CONCURRENCY", 8))
+HTTP_CONNECTIONS_PER_HOST = int(os.getenv("HTTP_CONNECTIONS_PER_HOST", 10))
+HTTP_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", 300))  # seconds
+# Starting request rate (per second) and concurrency per host, and the
+# ceilings they may grow to while the host doesn't throttle us
+RATE_LIMITS = {
+    "default": {
+        "rate": 20,
+        "max_rate": 200,
+        "concurrency": 4,
+        "max_concurrency": HTTP_CONNECTIONS_PER_HOST,
+    },
+    "query.wikidata.org": {
+        "rate": 5,
+        "max_rate": 10,
+        "concurrency": 2,
+        "max_concurrency": 5,
+    },
+}
+RETRY_BACKOFF = float(os.getenv("RETRY_BACKOFF", 6))  # hours
+RETRY_MAX_BACKOFF = float(os.getenv("RETRY_MAX_BACKOFF", 168))
+INVENTORY_MAX_AGE = float(os.getenv("INVENTORY_MAX_AGE", 24))  # hours
+IMS_METADATA = os.getenv("IMS_METADATA", "data/output/faltantes.csv")
+IMS_CHUNKSIZE = int(os.getenv("IMS_CHUNKSIZE", 5000))  # records, 0 for all at once
+IMS_FORMATTED = os.getenv("IMS_FORMATTED", "data/output/ims_formatted.parquet")
+IMS_DELTA = os.getenv("IMS_DELTA", "data/output/ims_delta.json")
+IMS_REFORMAT = os.getenv("IMS_REFORMAT", False)
+SOURCE_MANIFEST = os.getenv("SOURCE_MANIFEST", "data/cache/source_manifest.json")
+LEDGER = os.getenv("LEDGER", "data/cache/ledger.sqlite")
+# "true" stats every source again, else only those about to be handled
+SOURCE_RESTAT = os.getenv("SOURCE_RESTAT", "false")
+SCAN_WORKERS = int(os.getenv("SCAN_WORKERS", 16))
+PIPELINE_COPY_WORKERS = int(os.getenv("PIPELINE_COPY_WORKERS", 8))
+PIPELINE_CONVERT_WORKERS = int(os.getenv("PIPELINE_CONVERT_WORKERS", os.cpu_count()))
+COPY_VERIFY = os.getenv("COPY_VERIFY", "stat")  # or "hash"
+COPY_MODIFY_WINDOW = float(os.getenv("COPY_MODIFY_WINDOW", 1))  # seconds
+# TIFFs read into memory per conversion worker, capped so that all
+# workers together hold at most TEE_BUDGET_MB
+TEE_MAX_BYTES = (
+    min(
+        int(os.getenv("TEE_MAX_MB", 64)),
+        int(os.getenv("TEE_BUDGET_MB", 1024)) // PIPELINE_CONVERT_WORKERS,
+    )
+    * 2**20
+)
+THUMBNAIL_SIZE = int(os.getenv("THUMBNAIL_SIZE", 1000))  # pixels
+PIPELINE_QUEUE_SIZE = int(os.getenv("PIPELINE_QUEUE_SIZE", 64))  # items per stage
+EXIFTOOL_WORKERS = int(os.getenv("EXIFTOOL_WORKERS", 4))  # persistent processes
+EXIFTOOL_BATCH = int(
+    os.getenv("EXIFTOOL_BATCH", 0)
+)  # JPGs per argfile, 0 for one at a time
+EXIFTOOL_OVERWRITE_ORIGINAL = os.getenv("EXIFTOOL_OVERWRITE_ORIGINAL", False)
+PORTALS = os.getenv("PORTALS", "data/output/portals.csv")
+PORTALS_OVERLAP = int(os.getenv("PORTALS_OVERLAP", 1000))  # items
+PORTALS_RESYNC = os.getenv("PORTALS_RESYNC", False)
+PORTALS_SORT = os.getenv("PORTALS_SORT", "ID:ascending")
+PORTALS_MAX_SEARCHES = int(os.getenv("PORTALS_MAX_SEARCHES", 100))  # ids
 RIGHTS = {
     "Copyright Not Evaluated": "http://rightsstatements.org/vocab/CNE/1.0/",
     "Copyright Undetermined": "http://rightsstatements.org/vocab/UND/1.0/",
@@ -1,3 +1,4 @@
+import io
 import math
 import os
 import re
@@ -9,15 +10,14 @@ import geojson
 import mercantile
 import numpy as np
 import pandas as pd
-import requests
 from lxml import etree
 from PIL import Image
 from pyproj import Proj
 from shapely.geometry import Point
-from SPARQLWrapper import JSON, SPARQLWrapper
 from turfpy.misc import sector
 
-from ..utils.helpers import geo_to_world_coors, query_wikidata
+from ..utils import network
+from ..utils.helpers import geo_to_world_coors, query_wikidata_async
 from ..utils.logger import logger
 
 
@@ -32,7 +32,7 @@ class KML:
         try:
             self._tree = etree.parse(path)
         except OSError:
-            self._tree = etree.fromstring(requests.get(path).content)
+            self._tree = etree.fromstring(network.get(path).content)
         self._folder = self._tree.find(
             "kml:Folder", namespaces={"kml": "http://www.opengis.net/kml/2.2"}
         )
@@ -204,10 +204,11 @@ class PhotoOverlay:
         pixel_column = int(np.interp(self._Longitude, [westmost, eastmost], [0, 256]))
         pixel_row = int(np.interp(self._Latitude, [southmost, northmost], [256, 0]))
         tile_img = Image.open(
-            requests.get(
-                "https://api.mapbox.com/v4/mapbox.terrain-rgb/10/800/200.pngraw?access_token=pk.eyJ1IjoibWFydGltcGFzc29zIiwiYSI6ImNra3pmN2QxajBiYWUycW55N3E1dG1tcTEifQ.JFKSI85oP7M2gbeUTaUfQQ",
-                stream=True,
-            ).raw
+            io.BytesIO(
+                network.get(
+                    "https://api.mapbox.com/v4/mapbox.terrain-rgb/10/800/200.pngraw?access_token=pk.eyJ1IjoibWFydGltcGFzc29zIiwiYSI6ImNra3pmN2QxajBiYWUycW55N3E1dG1tcTEifQ.JFKSI85oP7M2gbeUTaUfQQ",
+                ).content
+            )
         ).load()
         R, G, B, _ = tile_img[pixel_row, pixel_column]
         height = -10000 + ((R * 256 * 256 + G * 256 + B) * 0.1)
@@ -238,25 +239,23 @@ class PhotoOverlay:
         if isinstance(self._depicts, str):
             depicts = self._depicts.split("|")
             distances = []
-            points = []
+            qs = []
             for depict in depicts:
                 try:
-                    q = vocabulary.loc[depict, "Wikidata ID"]
-                    point = query_wikidata(q)
-                    if point:
-                        points.append(point[0])
-                    else:
-                        continue
+                    qs.append(vocabulary.loc[depict, "Wikidata ID"])
                 except (KeyError, AttributeError):
                     continue
-                for point in points:
-                    lnglat = re.search("\((-\d+\.\d+) (-\d+\.\d+)\)", point)
-                    lng = float(lnglat.group(1))
-                    lat = float(lnglat.group(2))
-                    depicted = geo_to_world_coors(coors=(lng, lat))
-                    origin = geo_to_world_coors(coors=(self._Longitude, self._Latitude))
-                    distance = origin.distance(depicted)
-                    distances.append(distance)
+            # query every depicted entity at once
+            results = network.gather(query_wikidata_async(q) for q in qs)
+            points = [point[0] for point in results if point]
+            for point in points:
+                lnglat = re.search("\((-\d+\.\d+) (-\d+\.\d+)\)", point)
+                lng = float(lnglat.group(1))
+                lat = float(lnglat.group(2))
+                depicted = geo_to_world_coors(coors=(lng, lat))
+                origin = geo_to_world_coors(coors=(self._Longitude, self._Latitude))
+                distance = origin.distance(depicted)
+                distances.append(distance)
             if distances:
                 self._radius = max(distances) / 1000
             else:
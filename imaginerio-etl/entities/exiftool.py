@@ -57,10 +57,16 @@ from __future__ import unicode_literals
 
 import sys
 import subprocess
+import asyncio
 import os
 import json
 import warnings
 import codecs
+import itertools
+import queue
+import threading
+from concurrent.futures import Future
+from contextlib import contextmanager
 
 try:        # Py3k compatibility
     basestring
@@ -75,13 +81,17 @@ If the executable is not located in one of the paths listed in the
 """
 
 # Sentinel indicating the end of the output of a sequence of commands.
-# The standard value should be fine.
+# The standard value should be fine.  Each command is numbered, and
+# exiftool echoes the number inside the sentinel, e.g. ``{ready12}``.
 sentinel = b"{ready}"
 
 # The block size when reading from exiftool.  The standard value
 # should be fine, though other values might give better performance in
 # some cases.
-block_size = 4096
+block_size = 65536
+
+# The number of files per command in :py:meth:`ExifTool.get_metadata_batch()`.
+batch_size = 500
 
 # This code has been adapted from Lib/os.py in the Python source tree
 # (sha1 265e36e277f3)
@@ -112,6 +122,9 @@ def _fscodec():
 fsencode = _fscodec()
 del _fscodec
 
+def _loads(output):
+    return json.loads(output.decode("utf-8"))
+
 class ExifTool(object):
     """Run the `exiftool` command-line tool and communicate to it.
 
@@ -172,6 +185,12 @@ class ExifTool(object):
                  "-common_args", "-G", "-n"],
                 stdin=subprocess.PIPE, stdout=subprocess.PIPE,
                 stderr=devnull)
+        self._lock = threading.Lock()
+        self._count = itertools.count(1)
+        self._pending = queue.Queue()
+        self._exited = False
+        self._reader = threading.Thread(target=self._read, daemon=True)
+        self._reader.start()
         self.running = True
 
     def terminate(self):
@@ -181,12 +200,25 @@ class ExifTool(object):
         """
         if not self.running:
             return
-        self._process.stdin.write(b"-stay_open\nFalse\n")
-        self._process.stdin.flush()
+        try:
+            self._process.stdin.write(b"-stay_open\nFalse\n")
+            self._process.stdin.flush()
+        except (BrokenPipeError, ValueError):
+            # the process exited already
+            pass
+        # wakes the reader up once it's done with pending commands
+        self._pending.put(None)
+        self._reader.join()
         self._process.communicate()
         del self._process
         self.running = False
 
+    @property
+    def alive(self):
+        """Whether this instance has a subprocess that hasn't exited."""
+        return (self.running and not self._exited
+                and self._process.poll() is None)
+
     def __enter__(self):
         self.start()
         return self
@@ -197,6 +229,71 @@ class ExifTool(object):
     def __del__(self):
         self.terminate()
 
+    def _read(self):
+        """Read ``exiftool`` output, resolving the futures returned by
+        :py:meth:`submit()` in order as their sentinels come in.
+
+        Runs in a thread of its own.  Output accumulates in a single
+        growable buffer, and each sentinel is searched for only in the
+        part of it that wasn't searched yet.
+        """
+        fd = self._process.stdout.fileno()
+        buffer = bytearray()
+        while True:
+            item = self._pending.get()
+            if item is None:
+                return
+            number, future = item
+            end = sentinel[:-1] + str(number).encode() + sentinel[-1:]
+            start = 0
+            while (found := buffer.find(end, start)) < 0:
+                start = max(0, len(buffer) - len(end) + 1)
+                block = os.read(fd, block_size)
+                if not block:
+                    self._fail(future)
+                    return
+                buffer += block
+            output = bytes(buffer[:found]).lstrip()
+            del buffer[:found + len(end)]
+            future.set_result(output)
+
+    def _fail(self, future):
+        with self._lock:
+            self._exited = True
+        error = IOError("ExifTool process exited.")
+        future.set_exception(error)
+        while True:
+            try:
+                item = self._pending.get_nowait()
+            except queue.Empty:
+                return
+            if item is not None:
+                item[1].set_exception(error)
+
+    def submit(self, *params):
+        """Send the given batch of parameters to ``exiftool`` without
+        waiting for its output.
+
+        Parameters are the same as for :py:meth:`execute()`.  The return
+        value is a :py:class:`concurrent.futures.Future` resolved with
+        the output once ``exiftool`` is done with the batch, so that
+        many commands can be queued up and the process kept busy while
+        the caller prepares the next ones or handles earlier results.
+        Outputs are returned in the order commands were submitted.
+        """
+        if not self.running:
+            raise ValueError("ExifTool instance not running.")
+        future = Future()
+        with self._lock:
+            if self._exited:
+                raise IOError("ExifTool process exited.")
+            number = next(self._count)
+            self._pending.put((number, future))
+            self._process.stdin.write(b"\n".join(
+                params + (b"-execute%d\n" % number,)))
+            self._process.stdin.flush()
+        return future
+
     def execute(self, *params):
         """Execute the given batch of parameters with ``exiftool``.
 
@@ -216,15 +313,12 @@ class ExifTool(object):
         .. note:: This is considered a low-level method, and should
            rarely be needed by application developers.
         """
-        if not self.running:
-            raise ValueError("ExifTool instance not running.")
-        self._process.stdin.write(b"\n".join(params + (b"-execute\n",)))
-        self._process.stdin.flush()
-        output = b""
-        fd = self._process.stdout.fileno()
-        while not output[-32:].strip().endswith(sentinel):
-            output += os.read(fd, block_size)
-        return output.strip()[:-len(sentinel)]
+        return self.submit(*params).result()
+
+    async def execute_async(self, *params):
+        """Coroutine version of :py:meth:`execute()`, for use from an
+        ``asyncio`` event loop."""
+        return await asyncio.wrap_future(self.submit(*params))
 
     def execute_json(self, *params):
         """Execute the given batch of parameters and parse the JSON output.
@@ -248,16 +342,28 @@ class ExifTool(object):
         respective Python version – as raw strings in Python 2.x and
         as Unicode strings in Python 3.x.
         """
-        params = map(fsencode, params)
-        return json.loads(self.execute(b"-j", *params).decode("utf-8"))
+        return _loads(self.execute(*self._json_params(params)))
+
+    def _json_params(self, params):
+        return (b"-j",) + tuple(map(fsencode, params))
 
     def get_metadata_batch(self, filenames):
         """Return all meta-data for the given files.
 
         The return value will have the format described in the
-        documentation of :py:meth:`execute_json()`.
+        documentation of :py:meth:`execute_json()`.  Files are sent to
+        ``exiftool`` in commands of ``batch_size`` files, all submitted
+        upfront, so that it reads the next ones while the output of
+        the previous ones is parsed.
         """
-        return self.execute_json(*filenames)
+        filenames = list(filenames)
+        futures = [
+            self.submit(*self._json_params(filenames[i:i + batch_size]))
+            for i in range(0, len(filenames), batch_size)]
+        result = []
+        for future in futures:
+            result.extend(_loads(future.result()))
+        return result
 
     def get_metadata(self, filename):
         """Return meta-data for a single file.
@@ -323,3 +429,95 @@ class ExifTool(object):
         ``None`` if this tag was not found in the file.
         """
         return self.get_tag_batch(tag, [filename])[0]
+
+
+class ExifToolPool(object):
+    """Share a number of running :py:class:`ExifTool` instances
+    between threads.
+
+    Starting ``exiftool`` means starting a Perl interpreter, which
+    takes much longer than most commands it then runs.  A pool keeps
+    ``size`` instances running for as long as it is itself running
+    and lends each of them to one thread at a time
+    with :py:meth:`worker()`::
+
+        with ExifToolPool(4) as pool:
+            with pool.worker() as et:
+                et.execute(...)
+
+    An instance whose process exited is restarted before being lent
+    again, and so is one that raised ``OSError`` (e.g. a broken pipe)
+    while in use, since its output can't be trusted to be in sync
+    with its commands any more.
+
+    .. py:attribute:: restarts
+
+       The number of instances restarted so far.
+    """
+
+    def __init__(self, size=1, executable_=None):
+        self.size = size
+        self.executable = executable_
+        self.running = False
+        self.restarts = 0
+        self._idle = queue.Queue()
+
+    def start(self):
+        """Start the ``exiftool`` processes of this pool."""
+        if self.running:
+            warnings.warn("ExifToolPool already running; doing nothing.")
+            return
+        for _ in range(self.size):
+            self._idle.put(self._spawn())
+        self.running = True
+
+    def terminate(self):
+        """Terminate the processes of this pool.
+
+        This waits for the instances lent to other threads to be
+        given back.
+        """
+        if not self.running:
+            return
+        for _ in range(self.size):
+            self._idle.get().terminate()
+        self.running = False
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.terminate()
+
+    def _spawn(self):
+        et = ExifTool(self.executable)
+        et.start()
+        return et
+
+    def _restart(self, et):
+        if et.running:
+            et._process.kill()
+            et.terminate()
+        self.restarts += 1
+        return self._spawn()
+
+    @contextmanager
+    def worker(self):
+        """Lend a running :py:class:`ExifTool` instance to the caller.
+
+        Blocks until an instance is idle.  The instance is given back
+        to the pool when the ``with`` block exits.
+        """
+        if not self.running:
+            raise ValueError("ExifToolPool not running.")
+        et = self._idle.get()
+        try:
+            if not et.alive:
+                et = self._restart(et)
+            yield et
+        except OSError:
+            et = self._restart(et)
+            raise
+        finally:
+            self._idle.put(et)
@@ -1,11 +1,18 @@
+import io
 import os
-import shutil
+import re
+import subprocess
 import sys
+import tempfile
 
-from exiftool import ExifTool
+import numpy as np
+import pandas as pd
 from PIL import Image as PILImage
 
 from ..config import *
+from . import exiftool
+from .exiftool import ExifTool
+from ..utils.copier import copy_file, same_stat, stat
 from ..utils.helpers import logger
 
 PILImage.MAX_IMAGE_PIXELS = None
@@ -14,57 +21,263 @@ PILImage.MAX_IMAGE_PIXELS = None
 class Tif(object):
     def copy(self, image):
         logger.debug("Copying {} to {}".format(image.id, os.environ["TIF"]))
-        shutil.copy2(image.original_path, os.environ["TIF"])
+        copy_file(image.original_path, os.path.join(os.environ["TIF"], image.tif))
+        image.mark("copied")
 
 
 class Highres(object):
     def copy(self, image):
         origin = os.path.join(os.environ["TIF"], image.tif)
+        self.convert(image, origin)
+
+    def convert(self, image, origin):
+        """
+        Save a JPEG from a TIFF path or file object
+        """
         destination = os.path.join(os.environ["JPG"], image.jpg)
-        logger.debug("Copying {} to {}".format(origin, destination))
+        logger.debug("Copying {} to {}".format(image.tif, destination))
+        # an interrupted conversion must not pass for a JPG
+        root, extension = os.path.splitext(destination)
+        partial = f"{root}.part{extension}"
         try:
             with PILImage.open(origin) as im:
                 im.save(
-                    destination,
+                    partial,
                     "jpeg",
                     quality=95,
                     icc_profile=im.info.get("icc_profile"),
                 )
+            os.replace(partial, destination)
         except OSError as e:
-            logger.debug(f"Cannot convert {image.tif}")
+            logger.warning(f"Cannot convert {image.tif}: {e}")
+            if os.path.exists(partial):
+                os.remove(partial)
+            raise
+        image.mark("converted")
 
 
-class Lowres(object):
+class TifHighres(object):
+    """
+    Copy the TIFF and convert it to JPEG reading the source once. Files
+    up to TEE_MAX_BYTES are read into memory, written to TIF and decoded
+    from the same buffer, larger ones are decoded from the fresh copy
+    while it's still in the page cache
+    """
+
     def copy(self, image):
-        origin = os.path.join(os.environ["TIF"], image.tif)
+        if os.path.getsize(image.original_path) > TEE_MAX_BYTES:
+            Tif().copy(image)
+            Highres().copy(image)
+            return
+
+        logger.debug("Copying {} to {}".format(image.id, os.environ["TIF"]))
+        with open(image.original_path, "rb") as f:
+            data = f.read()
+        destination = os.path.join(os.environ["TIF"], image.tif)
+        copy_file(image.original_path, destination, data)
+        image.mark("copied")
+        Highres().convert(image, io.BytesIO(data))
+
+
+class Lowres(object):
+    """
+    Thumbnail for review (catalogued images) or the backlog (the rest),
+    made from the JPG when there is one, which Pillow decodes in draft
+    mode at a fraction of its size, else from the TIF with libvips,
+    which streams it through the shrink instead of decoding it whole.
+    Thumbnails newer than their source are kept
+    """
+
+    def paths(self, image):
+        origin = os.path.join(os.environ["JPG"], image.jpg)
+        if not os.path.exists(origin):
+            origin = os.path.join(os.environ["TIF"], image.tif)
         if image.to_review:
-            destination = os.path.join(REVIEW, image.jpg)
+            destination = os.path.join(os.environ["REVIEW"], image.jpg)
         else:
             destination = os.path.join(os.environ["BACKLOG"], image.jpg)
+        return origin, destination
+
+    def outdated(self, image):
+        origin, destination = self.paths(image)
+        try:
+            return os.stat(destination).st_mtime_ns <= os.stat(origin).st_mtime_ns
+        except FileNotFoundError:
+            return True
+
+    def thumbnail(self, origin, destination):
+        with PILImage.open(origin) as im:
+            # JPEGs are decoded DCT scaled to the smallest size that
+            # still covers the thumbnail, instead of in full
+            im.draft("RGB", (THUMBNAIL_SIZE, THUMBNAIL_SIZE))
+            im.thumbnail((THUMBNAIL_SIZE, THUMBNAIL_SIZE))
+            im.save(destination, "jpeg")
+
+    def vips_thumbnail(self, origin, destination):
+        """
+        Shrink a TIFF with libvips, which reads only the reduced pages
+        of pyramidal TIFFs. Decoded in full by Pillow without libvips
+        """
+        command = [
+            "vips",
+            "thumbnail",
+            origin,
+            destination,
+            str(THUMBNAIL_SIZE),
+            "--height",
+            str(THUMBNAIL_SIZE),
+            "--size",
+            "down",
+        ]
+        try:
+            subprocess.run(command, check=True, capture_output=True)
+        except FileNotFoundError:
+            self.thumbnail(origin, destination)
+
+    def copy(self, image):
+        if not self.outdated(image):
+            logger.debug(f"{image.id} thumbnail is up to date")
+            return
+        origin, destination = self.paths(image)
         logger.debug("Copying {} to {}".format(origin, destination))
+        # an interrupted thumbnail would look newer than its source
+        root, extension = os.path.splitext(destination)
+        partial = f"{root}.part{extension}"
         try:
-            with PILImage.open(origin) as im:
-                im.thumbnail((1000, 1000))
-                im.save(destination)
-        except OSError:
-            logger.debug(f"Cannot convert {image.tif}")
+            if origin.endswith(".tif"):
+                self.vips_thumbnail(origin, partial)
+            else:
+                self.thumbnail(origin, partial)
+            os.replace(partial, destination)
+        except (OSError, subprocess.CalledProcessError) as e:
+            logger.warning(f"Cannot make a thumbnail of {image.id}: {e}")
+            if os.path.exists(partial):
+                os.remove(partial)
+            raise
+
+
+def build_exiftool_args(metadata):
+    """
+    ExifTool arguments embedding each catalog record, a list of
+    UTF-8 encoded tag assignments by Document ID, formatted for all
+    records at once. Empty if metadata lacks any of the columns used
+    """
+    try:
+        df = metadata[
+            [
+                "Creator",
+                "Document URL",
+                "Title",
+                "Description (Portuguese)",
+                "Material",
+                "Depicts",
+                "Latitude",
+                "Longitude",
+                "Date",
+            ]
+        ]
+    except KeyError:
+        return pd.Series(dtype=object)
+    df = df[~df.index.duplicated()].fillna("").astype(str)
+    id = pd.Series(df.index, index=df.index).astype(str)
+
+    def encode(values):
+        return values.str.encode("utf-8")
+
+    def constant(value):
+        return pd.Series(value.encode("utf-8"), index=df.index)
+
+    columns = [
+        encode(
+            "-xmp:artworkorobject={aosource=Instituto Moreira Salles,"
+            "aocopyrightnotice=Public Domain,aocreator="
+            + df["Creator"]
+            + ",aosourceinvno="
+            + id
+            + ",aosourceinvurl="
+            + df["Document URL"]
+            + ",aotitle="
+            + df["Title"]
+            + ",aocontentdescription="
+            + df["Description (Portuguese)"]
+            + ",aophysicaldescription="
+            + df["Material"]
+            + "}"
+        ),
+        constant("-iptc:city=Rio de Janeiro"),
+        constant("-iptc:province-State=RJ"),
+        constant("-iptc:country-primarylocationname=Brasil"),
+        encode("-iptc:keywords=" + df["Depicts"].str.replace("||", ",", regex=False)),
+        encode("-exif:gpslatitude=" + df["Latitude"]),
+        encode("-exif:gpslongitude=" + df["Longitude"]),
+        constant("-exif:gpslatituderef=S"),
+        constant("-exif:gpslongituderef=W"),
+        constant("-exif:gpsaltituderef=0"),
+        constant("-exif:gpsimgdirectionref=T"),
+        # "-IPTC:Dimensions={}x{}mm".format(item["Width"], item["Height"]),
+        # "-GPSAltitude={}".format(item["Altitude"]),
+        # "-GPSImgDirection={}".format(item["Bearing"]),
+        encode(
+            np.where(
+                df["Date"].str.contains("circa", regex=False),
+                "-xmp:AOCircaDateCreated=",
+                "-xmp:AODateCreated=",
+            )
+            + df["Date"]
+        ),
+    ]
+    return pd.Series(list(map(list, zip(*columns))), index=df.index, dtype=object)
 
 
 class Image:
-    def __init__(self, original_path, metadata):
+    def __init__(
+        self,
+        original_path,
+        metadata,
+        tifs=None,
+        jpgs=None,
+        source=None,
+        args=None,
+        state=None,
+    ):
+        """
+        tifs maps the file names already in the TIF directory to their
+        (size, mtime) and jpgs has the ones in the JPG directory, both
+        checked on disk when not given. source is the original's
+        (size, mtime), if already known. args is the table
+        build_exiftool_args makes of metadata, if already built. state
+        has the to_tif, to_jpg and to_embed flags the ledger recorded,
+        which take the place of checking files
+        """
         self.__original_path = original_path
         self.__id = os.path.split(self.__original_path)[1].split(".")[0]
         self.__jpg = self.__id + ".jpg"
         self.__tif = self.__id + ".tif"
+        self.__jpgs = jpgs
         self.__in_catalog = self.__id in metadata.index
-        self.__to_tif = not os.path.exists(os.path.join(os.environ["TIF"], self.__tif))
-        self.__to_jpg = (
-            not os.path.exists(os.path.join(os.environ["JPG"], self.__jpg))
-            and self.__in_catalog
-        )
+        if state is not None:
+            self.__to_tif = state["to_tif"]
+            self.__to_jpg = state["to_jpg"] and self.__in_catalog
+        else:
+            # a copy that doesn't match the original (e.g. an interrupted one) is redone
+            if tifs is None:
+                copy = stat(os.path.join(os.environ["TIF"], self.__tif))
+            else:
+                copy = tifs.get(self.__tif)
+            self.__to_tif = not same_stat(source or stat(original_path), copy)
+            if jpgs is None:
+                self.__to_jpg = (
+                    not os.path.exists(os.path.join(os.environ["JPG"], self.__jpg))
+                    and self.__in_catalog
+                )
+            else:
+                self.__to_jpg = self.__jpg not in jpgs and self.__in_catalog
         self.__metadata = None
-        if not self.has_embedded_metadata:
-            self.get_metadata(metadata)
+        self.__embedded = None
+        self.__done = set()
+        self.__to_embed = None if state is None else state["to_embed"]
+        # looked up on first use
+        self.__pending = metadata if args is None else args
 
     @property
     def original_path(self):
@@ -96,83 +309,172 @@ class Image:
 
     @property
     def to_review(self):
-        return self.__to_review
+        return self.__in_catalog
+
+    @property
+    def to_backlog(self):
+        return not self.__in_catalog
 
     @property
     def on_cloud(self):
         return self.__on_cloud
 
+    @property
+    def to_embed(self):
+        if self.__to_embed is None:
+            return not self.has_embedded_metadata
+        return self.__to_embed
+
     @property
     def has_embedded_metadata(self):
-        return os.path.exists(
-            os.path.join(os.environ["JPG"], "{}_original".format(self.__jpg))
-        )
+        original = "{}_original".format(self.__jpg)
+        if self.__jpgs is not None:
+            return original in self.__jpgs
+        return os.path.exists(os.path.join(os.environ["JPG"], original))
 
     @property
     def metadata(self):
+        """
+        ExifTool arguments embedding the catalog record, None if already
+        embedded or unavailable
+        """
+        if self.__pending is not None:
+            source, self.__pending = self.__pending, None
+            if self.to_embed:
+                self.get_metadata(source)
         return self.__metadata
 
-    def copy_strategy(self, strategy):
+    @property
+    def embedded(self):
+        """
+        Whether the last embedding updated the JPG, None if not tried
+        """
+        return self.__embedded
+
+    @property
+    def done(self):
+        """
+        Names of the stages (copied, converted) completed for the image
+        """
+        return self.__done
+
+    def mark(self, stage):
+        self.__done.add(stage)
+
+    def copy_strategy(self, strategy=None):
+        """
+        Copy with strategy, or with the one matching what the image needs
+        """
+        if strategy is None:
+            if self.__to_tif and self.__to_jpg:
+                strategy = TifHighres()
+            elif self.__to_tif:
+                strategy = Tif()
+            elif self.__to_jpg:
+                strategy = Highres()
+            else:
+                return
         strategy.copy(self)
 
     def get_metadata(self, metadata):
-        try:
-            item = metadata.loc[self.__id].copy()
-            item.fillna(value="", inplace=True)
-            self.__metadata = [
-                param.encode(encoding="utf-8")
-                for param in [
-                    "-xmp:artworkorobject={{aosource=Instituto Moreira Salles,aocopyrightnotice=Public Domain,aocreator={0},aosourceinvno={1},aosourceinvurl={2},aotitle={3},aocontentdescription={4},aophysicaldescription={5}}}".format(
-                        item["Creator"],
-                        self.__id,
-                        item["Document URL"],
-                        item["Title"],
-                        item["Description (Portuguese)"],
-                        item["Material"],
-                    ),
-                    "-iptc:city=Rio de Janeiro",
-                    "-iptc:province-State=RJ",
-                    "-iptc:country-primarylocationname=Brasil",
-                    "-iptc:keywords={}".format(",".join(item["Depicts"].split("||"))),
-                    "-exif:gpslatitude={}".format(item["Latitude"]),
-                    "-exif:gpslongitude={}".format(item["Longitude"]),
-                    "-exif:gpslatituderef=S",
-                    "-exif:gpslongituderef=W",
-                    "-exif:gpsaltituderef=0",
-                    "-exif:gpsimgdirectionref=T",
-                    # "-IPTC:Dimensions={}x{}mm".format(item["Width"], item["Height"]),
-                    # "-GPSAltitude={}".format(item["Altitude"]),
-                    # "-GPSImgDirection={}".format(item["Bearing"]),
-                ]
-            ]
-            if "circa" in item["Date"]:
-                self.__metadata.append(
-                    "-xmp:AOCircaDateCreated={}".format(item["Date"]).encode(
-                        encoding="utf-8"
-                    )
-                ),
+        """
+        Look the image's ExifTool arguments up in metadata, catalog
+        records or the table build_exiftool_args makes of them
+        """
+        if isinstance(metadata, pd.DataFrame):
+            if self.__id in metadata.index:
+                metadata = build_exiftool_args(metadata.loc[[self.__id]])
             else:
-                self.__metadata.append(
-                    "-xmp:AODateCreated={}".format(item["Date"]).encode(
-                        encoding="utf-8"
-                    ),
-                )
-        except KeyError:
-            self.__metadata = None
+                metadata = {}
+        self.__metadata = metadata.get(self.__id)
+        if self.__metadata is None:
             logger.debug(f"{self.id} metadata unavailable")
 
-    def embed_metadata(self):
-        if self.__metadata:
+    def embed_metadata(self, et=None):
+        """
+        Write the catalog metadata to the JPG with et, a running
+        ExifTool (e.g. from a pool), or one started just for it
+        """
+        if not self.metadata:
+            logger.debug(f"Skipping {self.id} metadata embedding")
+            return
+        if et is None:
             with ExifTool() as et:
-                et.execute(
-                    *self.__metadata,
-                    os.path.join(os.environ["JPG"], self.__jpg).encode(
-                        encoding="utf-8"
-                    ),
+                return self.embed_metadata(et)
+        output = et.execute(*self.metadata, self.__jpg_path())
+        self.__embedded = bool(re.search(rb"1 image files (updated|unchanged)", output))
+        if not self.__embedded:
+            # not an OSError, which would have the pool restart a sound ExifTool
+            raise RuntimeError(
+                f"ExifTool didn't update {self.jpg}: "
+                + output.decode("utf-8", "replace").strip()
+            )
+        logger.debug(f"Embedded metadata in {self.id}")
+
+    def __jpg_path(self):
+        return os.path.join(os.environ["JPG"], self.__jpg).encode(encoding="utf-8")
+
+    @classmethod
+    def embed_metadata_batch(
+        cls, images, overwrite_original=EXIFTOOL_OVERWRITE_ORIGINAL
+    ):
+        """
+        Write the catalog metadata of many images with a single exiftool
+        run, from an argfile with a -execute block per JPG, each echoing
+        a marker once done to tell which ones were updated. Sets their
+        embedded and returns the images that were, or needed nothing.
+        If overwrite_original is "true" exiftool keeps no _original
+        backups, which has_embedded_metadata relies on: those images are
+        embedded again on the next run
+        """
+        pending = [image for image in images if image.metadata]
+        if pending:
+            fd, argfile = tempfile.mkstemp(suffix=".args")
+            with os.fdopen(fd, "wb") as f:
+                for image in pending:
+                    marker = "{{{}}}".format(image.id).encode(encoding="utf-8")
+                    f.writelines(
+                        arg + b"\n"
+                        for arg in image.metadata
+                        + [b"-echo3", marker, image.__jpg_path(), b"-execute"]
+                    )
+            common = ["-G", "-n"]
+            if overwrite_original == "true":
+                common.append("-overwrite_original")
+            try:
+                result = subprocess.run(
+                    [exiftool.executable, "-@", argfile, "-common_args", *common],
+                    capture_output=True,
                 )
-            logger.debug(f"Embedded metadata in {self.id}")
-        else:
-            logger.debug(f"Skipping {self.id} metadata embedding")
+            finally:
+                os.remove(argfile)
+
+            updated, ok = set(), False
+            for line in result.stdout.decode("utf-8", "replace").splitlines():
+                line = line.strip()
+                if re.match(r"1 image files (updated|unchanged)", line):
+                    ok = True
+                elif line.startswith("{") and line.endswith("}"):
+                    if ok:
+                        updated.add(line[1:-1])
+                    ok = False
+            for image in pending:
+                image.__embedded = image.id in updated
+            logger.debug(f"Embedded metadata in {len(updated)} of {len(pending)} JPGs")
+            if len(updated) < len(pending):
+                logger.debug(result.stderr.decode("utf-8", "replace"))
+        return [image for image in images if not image.metadata or image.embedded]
+
+    def __getstate__(self):
+        """
+        Look the metadata up before pickling (e.g. for a process pool)
+        instead of sending the whole table and listing along with
+        each image
+        """
+        self.metadata
+        state = self.__dict__.copy()
+        state["_Image__jpgs"] = None
+        return state
 
     def __str__(self):
         of_interest = [
@@ -10,7 +10,8 @@ from PIL import Image
 logging.getLogger("PIL").setLevel(logging.WARNING)
 
 from ..config import *
-from ..utils.helpers import session, upload_folder_to_s3
+from ..utils import network
+from ..utils.helpers import upload_folder_to_s3
 from ..utils.logger import CustomFormatter as cf
 from ..utils.logger import logger
 
@@ -137,15 +138,19 @@ class Item:
             return []
 
     def get_sizes(self):
+        return network.client.run(self.fetch_sizes())
+
+    async def fetch_sizes(self):
         try:
-            img_sizes = session.get(self._info_path).json()["sizes"]
+            response = await network.client.get(self._info_path)
+            img_sizes = response.json()["sizes"]
             return img_sizes
         except JSONDecodeError:
             return None
 
     def download_image(self):
         logger.info(f"{cf.BLUE}Downloading image...{cf.RESET}")
-        response = session.get(self._jstor_img_path)
+        response = network.get(self._jstor_img_path)
         if response.status_code == 200:
             os.makedirs(os.path.dirname(self._local_img_path), exist_ok=True)
             with open(self._local_img_path, "wb") as handler:
@@ -156,8 +161,19 @@ class Item:
             )
             raise Exception(IOError)
 
+    def get_local_sizes(self):
+        with open(self._local_info_path) as f:
+            return json.load(f)["sizes"]
+
     def tile_image(self):
         self.download_image()
+        self.dzsave()
+        sizes = self.create_derivatives([16, 8, 4, 2, 1])
+        upload_folder_to_s3(f"iiif/{self._id}")
+        return sizes
+        # os.remove(os.path.abspath(self._local_img_path))
+
+    def dzsave(self):
         command = [
             "vips",
             "dzsave",
@@ -171,11 +187,7 @@ class Item:
             f"iiif/{self._id}",
         ]
         logger.info(f"{cf.BLUE}Tiling image...")
-        subprocess.run(command)
-        sizes = self.create_derivatives([16, 8, 4, 2, 1])
-        upload_folder_to_s3(f"iiif/{self._id}")
-        return sizes
-        # os.remove(os.path.abspath(self._local_img_path))
+        subprocess.run(command, check=True)
 
     def create_derivatives(self, factors):
         logger.info(f"{cf.BLUE}Creating derivatives...")
@@ -1,11 +1,84 @@
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+
 from ..config import *
 from ..entities.item import Item
-from ..utils.helpers import get_collections, get_vocabulary, upload_object_to_s3
+from ..utils import network
+from ..utils.helpers import (
+    get_collections,
+    get_vocabulary,
+    invalidations,
+    inventory,
+    upload_folder_to_s3,
+    upload_object_to_s3,
+)
+from ..utils.journal import Journal, fingerprint
+from ..utils.ratelimit import controller
 from ..utils.logger import CustomFormatter as cf
 from ..utils.logger import logger
 
 
-def update(metadata):
+def process_item(id, row, vocabulary, journal=None):
+    """
+    Tile the item's image if needed and create its manifest,
+    skipping stages the journal already holds for this row
+    """
+    item = Item(id, row, vocabulary)
+    uploaded = journal.get(id, "uploaded", fingerprint(row)) if journal else None
+    if uploaded:
+        sizes = uploaded["sizes"]
+    else:
+        sizes = item.get_sizes()
+        if not sizes or RETILE == "true":  # github action input, not boolean
+            sizes = tile_item(item, journal, fingerprint(row))
+    manifest = item.create_manifest(sizes)
+    return item, manifest
+
+
+def tile_item(item, journal, stamp):
+    """
+    Download, tile and upload an image, recording each stage
+    """
+    if journal is None:
+        return item.tile_image()
+
+    if not (
+        journal.done(item._id, "downloaded", stamp)
+        and os.path.exists(item._local_img_path)
+    ):
+        item.download_image()
+        journal.record(item._id, "downloaded", stamp)
+
+    if journal.done(item._id, "tiled", stamp) and os.path.exists(item._local_info_path):
+        sizes = item.get_local_sizes()
+    else:
+        item.dzsave()
+        sizes = item.create_derivatives([16, 8, 4, 2, 1])
+        journal.record(item._id, "tiled", stamp)
+
+    if not upload_folder_to_s3(f"iiif/{item._id}"):
+        raise IOError(f"Failed to upload tiles for item {item._id}")
+    journal.record(item._id, "uploaded", stamp, sizes=sizes)
+    return sizes
+
+
+def publish(manifest, id, journal=None, stamp=None, republish=False):
+    """
+    Upload a manifest unless the journal shows it's already published,
+    or regardless with republish, as manifest code may have changed
+    """
+    if not republish and journal and journal.done(id, "published", stamp):
+        logger.info(f"Manifest {id} already published, skipping upload")
+        return
+    if not upload_object_to_s3(manifest, id, f"iiif/{id}/manifest.json"):
+        raise IOError(f"Failed to publish manifest for item {id}")
+    if journal:
+        journal.record(id, "published", stamp)
+
+
+def update(metadata, journal=None, retry=None):
     n_items = len(metadata)
     logger.info(f"IIIF: {cf.GREEN}{n_items}{cf.RESET} to process")
     vocabulary = get_vocabulary(VOCABULARY)
@@ -17,12 +90,8 @@ def update(metadata):
     for index, (id, row) in enumerate(metadata.fillna("").iterrows()):
         logger.info(f"{cf.LIGHT_BLUE}{index+1}/{n_items}{cf.BLUE} - Parsing item {id}")
         try:
-            item = Item(id, row, vocabulary)
-            sizes = item.get_sizes()
-            if not sizes or RETILE == "true":  # github action input, not boolean
-                sizes = item.tile_image()
-            manifest = item.create_manifest(sizes)
-            upload_object_to_s3(manifest, item._id, f"iiif/{item._id}/manifest.json")
+            item, manifest = process_item(id, row, vocabulary, journal)
+            publish(manifest, id, journal, fingerprint(row))
             for name in item.get_collections():
                 collection = collections[name]
                 collection.items = [
@@ -30,20 +99,161 @@ def update(metadata):
                 ]
                 collection.add_item_by_reference(manifest)
             n_manifests += 1
+            if retry:
+                retry.succeed(id)
         except Exception:
             logger.exception(
-                f"{cf.RED}Couldn't create manifest for item {item._id}, skipping"
+                f"{cf.RED}Couldn't create manifest for item {id}, skipping"
             )
-            errors.append(item._id)
+            errors.append(id)
+            if retry:
+                retry.fail(id)
 
-    for name in collections.keys():
-        upload_object_to_s3(
-            collections[name], name, f"iiif/collection/{name.lower()}.json"
-        )
+    published = all(
+        [
+            upload_object_to_s3(
+                collections[name], name, f"iiif/collection/{name.lower()}.json"
+            )
+            for name in collections.keys()
+        ]
+    )
+    invalidations.flush()
+    inventory.save()
 
     return {
         "n_manifests": n_manifests,
         "n_items": n_items,
         "no_collection": no_collection,
         "errors": errors,
+        "published": published,
+        "network": controller.summary(),
+    }
+
+
+def process_shard(shard, vocabulary):
+    """
+    Create and publish the manifests of a slice of the catalog,
+    returning references to them grouped by collection so the
+    parent process can merge collection membership, along with
+    the published keys to invalidate and the uploaded objects
+    """
+    members = {}
+    errors = []
+    journal = Journal()
+    with ThreadPoolExecutor(max_workers=PUBLISH_CONCURRENCY) as publisher:
+        uploads = {}
+        for id, row in shard.fillna("").iterrows():
+            try:
+                item, manifest = process_item(id, row, vocabulary, journal)
+            except Exception:
+                logger.exception(
+                    f"{cf.RED}Couldn't create manifest for item {id}, skipping"
+                )
+                errors.append(id)
+                continue
+            # rebuilds exist to pick up manifest code changes,
+            # so they publish rows the journal has as published
+            uploads[id] = publisher.submit(
+                publish, manifest, id, journal, fingerprint(row), republish=True
+            )
+            for name in item.get_collections():
+                members.setdefault(name, []).append(manifest.to_reference())
+        for id, upload in uploads.items():
+            try:
+                upload.result()
+            except IOError:
+                logger.exception(f"{cf.RED}Couldn't publish item {id}")
+                errors.append(id)
+    journal.close()
+    network.close()
+
+    return members, errors, invalidations.drain(), inventory.drain()
+
+
+def rebuild(metadata, retry=None):
+    """
+    Regenerate every published manifest, splitting the catalog
+    into shards processed by a pool of workers
+    """
+    start = time.perf_counter()
+    metadata = metadata.loc[metadata["Status"] == "In imagineRio"]
+    n_items = len(metadata)
+    shards = [metadata.iloc[i : i + SHARD_SIZE] for i in range(0, n_items, SHARD_SIZE)]
+    logger.info(
+        f"IIIF: rebuilding {cf.GREEN}{n_items}{cf.RESET} items in "
+        f"{len(shards)} shards with {REBUILD_WORKERS} workers"
+    )
+    vocabulary = get_vocabulary(VOCABULARY)
+    collections = get_collections(metadata)
+    no_collection = metadata.loc[metadata["Collection"].isna()].index.to_list()
+    members = {}
+    errors = []
+    n_done = 0
+
+    # spawn instead of fork, module-level boto3 clients aren't fork-safe
+    with ProcessPoolExecutor(
+        max_workers=REBUILD_WORKERS, mp_context=multiprocessing.get_context("spawn")
+    ) as pool:
+        futures = {
+            pool.submit(process_shard, shard, vocabulary): shard for shard in shards
+        }
+        for future in as_completed(futures):
+            shard = futures[future]
+            try:
+                shard_members, shard_errors, published_keys, uploaded = future.result()
+            except Exception:
+                logger.exception(f"{cf.RED}Shard starting at {shard.index[0]} failed")
+                shard_members, shard_errors, published_keys, uploaded = (
+                    {},
+                    shard.index.to_list(),
+                    [],
+                    {},
+                )
+            invalidations.update(published_keys)
+            inventory.update(uploaded)
+            for name, references in shard_members.items():
+                members.setdefault(name, []).extend(references)
+            errors.extend(shard_errors)
+            n_done += len(shard)
+            rate = n_done / (time.perf_counter() - start)
+            logger.info(
+                f"{cf.LIGHT_BLUE}{n_done}/{n_items}{cf.BLUE} items processed "
+                f"({rate:.1f} items/s)"
+            )
+
+    # Replace existing references in a single pass per collection
+    for name, references in members.items():
+        collection = collections[name]
+        rebuilt = {ref.id for ref in references}
+        collection.items = [
+            ref for ref in collection.items or [] if ref.id not in rebuilt
+        ] + references
+
+    if retry:
+        for id in metadata.index:
+            if id in errors:
+                retry.fail(id)
+            else:
+                retry.succeed(id)
+
+    published = all(
+        [
+            upload_object_to_s3(
+                collections[name], name, f"iiif/collection/{name.lower()}.json"
+            )
+            for name in collections.keys()
+        ]
+    )
+    invalidations.flush()
+    inventory.save()
+
+    elapsed = time.perf_counter() - start
+    return {
+        "n_manifests": n_items - len(errors),
+        "n_items": n_items,
+        "no_collection": no_collection,
+        "errors": errors,
+        "published": published,
+        "network": controller.summary(),
+        "elapsed": elapsed,
     }
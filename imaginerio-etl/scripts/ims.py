@@ -1,70 +1,152 @@
 import argparse
+import json
 import os
 import re
-from xml.etree import ElementTree
 
 import numpy as np
 import pandas as pd
-from portals import main as query_portals
-from pull_images import main as pull_images
+import pyarrow as pa
+import pyarrow.parquet as pq
+from lxml import etree
 
+from ..config import *
 from ..utils.helpers import ims2jstor
+from ..utils.logger import logger
+from ..utils.merge import MetadataMerge
+from .portals import main as query_portals
+from .pull_images import main as pull_images
+
+NS = "{http://www.canto.com/ns/Export/1.0}"
+IMS_COLUMNS = [
+    "Document ID",
+    "Title",
+    "Creator",
+    "Description (Portuguese)",
+    "Date",
+    "First Year",
+    "Last Year",
+    "Type",
+    "Collection",
+    "Provider",
+    "Material",
+    "Fabrication Method",
+    "Rights",
+    "Required Statement",
+    "Width",
+    "Height",
+    "Document URL",
+    "Media URL",
+]
+# fixed so every appended chunk has the same column types,
+# whichever columns happen to be empty in it
+IMS_SCHEMA = pa.schema(
+    [
+        (column, pa.float64() if column in ("Width", "Height") else pa.string())
+        for column in IMS_COLUMNS
+    ]
+)
+# formatted output, with the hash of each record's raw fields
+FORMATTED_SCHEMA = IMS_SCHEMA.append(pa.field("fingerprint", pa.uint64()))
 
 
 def xml_to_df(path):
     """
     Build Pandas DataFrame from XML file
     """
-    # Find the uids
-
-    with open(path, encoding="utf8") as f:
-        tree = ElementTree.parse(f)
-        root = tree.getroot()
-
-    uids = {}
-    for thing in root[0][0]:
-        uids[thing.attrib["uid"]] = thing[0].text
-
-    table = {}
-    for field in uids.values():
-        table[field] = []
-
-    outDict = {"table": table, "uids": uids}
-
-    # Fill the records
-    ns = {"cumulus": "http://www.canto.com/ns/Export/1.0"}
-    for thing in root[1]:
-        added = set()
-        for field_value in thing.findall("cumulus:FieldValue", ns):
-            try:
-                if len(field_value) == 0:
-                    value = field_value.text.strip()
-                else:
-                    value = field_value[0].text.strip().split(":")
-                    value = str(value).strip("[']")
-
-                outDict["table"][outDict["uids"][field_value.attrib["uid"]]].append(
-                    value
-                )
-                added.add(field_value.attrib["uid"])
-            except KeyError:
-                continue
-        for missing in outDict["uids"].keys() - added:
-            try:
-                outDict["table"][outDict["uids"][missing]].append(None)
-            except KeyError:
-                continue
-    formated_table = outDict["table"]
-    cumulus_df = pd.DataFrame(formated_table).drop_duplicates()
+    return pd.concat(iter_xml_chunks(path), ignore_index=True)
+
+
+def iter_xml_chunks(path, chunksize=None):
+    """
+    Stream the Cumulus XML export, yielding DataFrames of at most
+    chunksize unique records (a single one if chunksize is None)
+    """
+    fields, positions, record_tag = read_layout(path)
+    columns = [[] for _ in fields]
+    # sorted hashes of the records yielded so far
+    seen = np.empty(0, dtype="uint64")
+    yielded = False
+    if record_tag is None:
+        yield build_chunk(fields, columns)
+        return
+
+    for _, record in etree.iterparse(path, events=("end",), tag=record_tag):
+        row = [None] * len(fields)
+        for field_value in record.iterchildren(f"{NS}FieldValue"):
+            position = positions.get(field_value.attrib["uid"])
+            if position is not None:
+                row[position] = field_value_text(field_value)
+        record.clear()
+        while record.getprevious() is not None:
+            del record.getparent()[0]
+
+        for column, value in zip(columns, row):
+            column.append(value)
+
+        if chunksize and len(columns[0]) >= chunksize:
+            chunk, seen = drop_seen(build_chunk(fields, columns), seen)
+            columns = [[] for _ in fields]
+            if len(chunk):
+                yielded = True
+                yield chunk
+
+    chunk, seen = drop_seen(build_chunk(fields, columns), seen)
+    if len(chunk) or not yielded:
+        yield chunk
+
+
+def drop_seen(chunk, seen):
+    """
+    Leave out the records of chunk repeated in it or among the seen
+    hashes, returning the rest and the hashes updated with them
+    """
+    hashes = pd.util.hash_pandas_object(chunk, index=False).to_numpy()
+    unseen = ~pd.Index(hashes).duplicated() & ~np.isin(hashes, seen)
+    return chunk[unseen].reset_index(drop=True), np.union1d(seen, hashes[unseen])
+
+
+def read_layout(path):
+    """
+    Read field names from the export layout, the first section,
+    and the tag used for records in the second one
+    """
+    fields, positions = [], {}
+    level = -1
+    section = -1
+    for event, element in etree.iterparse(path, events=("start", "end")):
+        if event == "start":
+            level += 1
+            if level == 1:
+                section += 1
+            if section == 1 and level == 2:
+                return fields, positions, element.tag
+            continue
+        level -= 1
+        if section == 0 and level == 2:
+            name = element[0].text
+            if name not in fields:
+                fields.append(name)
+            positions[element.attrib["uid"]] = fields.index(name)
+    return fields, positions, None
+
+
+def field_value_text(field_value):
+    if len(field_value) == 0:
+        return field_value.text.strip() if field_value.text else None
+    value = field_value[0].text.strip().split(":")
+    return str(value).strip("[']")
+
+
+def build_chunk(fields, columns):
+    cumulus_df = pd.DataFrame(dict(zip(fields, columns)))
 
     # load
     cumulus_df = cumulus_df.astype(
         {"DATA": str, "DATA LIMITE INFERIOR": str, "DATA LIMITE SUPERIOR": str},
         copy=False,
     )
-    cumulus_df[["DATA LIMITE SUPERIOR", "DATA LIMITE INFERIOR"]] = cumulus_df[
-        ["DATA LIMITE SUPERIOR", "DATA LIMITE INFERIOR"]
-    ].applymap(lambda x: x.split(".")[0])
+    for column in ["DATA LIMITE SUPERIOR", "DATA LIMITE INFERIOR"]:
+        cumulus_df[column] = cumulus_df[column].str.split(".", n=1).str[0]
 
     return cumulus_df
 
@@ -83,6 +165,69 @@ def extract_dimensions(df):
     return df
 
 
+DATE_PATTERN = r"([\d\/-]*\d{4}[-\/\d]*)"
+# year[-/month[-/day]] and [[day-/]month-/]year shapes of the export,
+# a/b/year being month-first unless a can't be a month
+DATE_SHAPES = [
+    r"^(?P<year>\d{4})$",
+    r"^(?P<a>\d{1,2})[/-](?P<year>\d{4})$",
+    r"^(?P<year>\d{4})[/-](?P<month>\d{1,2})$",
+    r"^(?P<a>\d{1,2})(?P<sep>[/-])(?P<b>\d{1,2})(?P=sep)(?P<year>\d{4})$",
+    r"^(?P<year>\d{4})(?P<sep>[/-])(?P<month>\d{1,2})(?P=sep)(?P<day>\d{1,2})$",
+]
+
+
+def parse_dates(dates):
+    """
+    Vectorized pd.to_datetime(errors="coerce", yearfirst=True), parsing
+    each distinct value once. Strings matching none of DATE_SHAPES, or
+    not a valid date in them, fall back to pandas' own parser
+    """
+    values = pd.Series(dates.dropna().unique(), dtype=object)
+    parts = pd.DataFrame(np.nan, index=values.index, columns=["year", "month", "day"])
+    for shape in DATE_SHAPES:
+        todo = parts["year"].isna()
+        match = values[todo].str.extract(shape).drop(columns="sep", errors="ignore")
+        match = match.astype(float).dropna(subset=["year"])
+        if match.empty:
+            continue
+        a = match.get("a", pd.Series(np.nan, index=match.index))
+        b = match.get("b", pd.Series(np.nan, index=match.index))
+        if "b" in match:
+            match["month"] = a.where(a <= 12, b)
+            match["day"] = b.where(a <= 12, a)
+        elif "a" in match:
+            match["month"] = a
+        parts.loc[match.index, ["year", "month", "day"]] = match.reindex(
+            columns=["year", "month", "day"]
+        ).to_numpy()
+    parts[["month", "day"]] = parts[["month", "day"]].fillna(1)
+    # pandas assembles the parts as a %Y%m%d number, out
+    # of range years and months must not spill over
+    valid = (
+        parts["year"].between(1678, 2261)
+        & parts["month"].between(1, 12)
+        & parts["day"].between(1, 31)
+    )
+    parts = parts.where(valid)
+
+    parsed = pd.to_datetime(parts, errors="coerce")
+    fallback = parsed.isna()
+    parsed[fallback] = pd.to_datetime(
+        values[fallback].map(
+            lambda x: pd.to_datetime(x, errors="coerce", yearfirst=True)
+        )
+    )
+    return dates.map(pd.Series(parsed.to_numpy(), index=values.to_numpy()))
+
+
+def format_years(years):
+    """
+    Integer years as strings, missing ones left as NaN
+    """
+    return years.astype("Int64").astype(str).where(years.notna(), np.nan)
+
+
 def format_dates(df):
     """
     Infer circa dates and format date string according to accuracy
@@ -98,42 +243,39 @@ def format_dates(df):
     accuracy_choices = ["year", "month", "day", "circa"]
     df["date_accuracy"] = np.select(accuracy_conditions, accuracy_choices)
 
-    # format dates
-
-    df["First Year"] = df["First Year"].str.extract(r"([\d\/-]*\d{4}[-\/\d]*)")
-    df["Last Year"] = df["Last Year"].str.extract(r"([\d\/-]*\d{4}[-\/\d]*)")
-    df["datetime"] = df["Date"].str.extract(r"([\d\/-]*\d{4}[-\/\d]*)")
-    df[["First Year", "Last Year", "datetime"]] = df[
-        ["First Year", "Last Year", "datetime"]
-    ].applymap(lambda x: pd.to_datetime(x, errors="coerce", yearfirst=True))
+    # parse dates
+    df["datetime"] = parse_dates(df["Date"].str.extract(DATE_PATTERN)[0])
+    first = parse_dates(df["First Year"].str.extract(DATE_PATTERN)[0]).dt.year
+    last = parse_dates(df["Last Year"].str.extract(DATE_PATTERN)[0]).dt.year
+    year = df["datetime"].dt.year
 
     circa = df["date_accuracy"] == "circa"
-    year = df["date_accuracy"] == "year"
-    month = df["date_accuracy"] == "month"
-    day = df["date_accuracy"] == "day"
 
     # infer first and last year when unavailable
-    df.loc[circa & df["First Year"].isna(), "First Year"] = df[
-        "datetime"
-    ] - pd.DateOffset(years=5)
-    df.loc[circa & df["Last Year"].isna(), "Last Year"] = df[
-        "datetime"
-    ] + pd.DateOffset(years=5)
-    df.loc[df["First Year"].isna(), "First Year"] = df["datetime"]
-    df.loc[df["Last Year"].isna(), "Last Year"] = df["datetime"]
+    first = first.fillna((year - 5).where(circa)).fillna(year)
+    last = last.fillna((year + 5).where(circa)).fillna(year)
+    df["First Year"] = format_years(first)
+    df["Last Year"] = format_years(last)
 
     # datetime to string according to date accuracy
-    df["First Year"] = df["First Year"].dt.strftime("%Y")
-    df["Last Year"] = df["Last Year"].dt.strftime("%Y")
-
-    format_conditions = [circa, year, month, day]
+    year = format_years(year)
+    month = format_years(df["datetime"].dt.month).str.zfill(2)
+    day = format_years(df["datetime"].dt.day).str.zfill(2)
+
+    format_conditions = [
+        circa,
+        df["date_accuracy"] == "year",
+        df["date_accuracy"] == "month",
+        df["date_accuracy"] == "day",
+    ]
     format_choices = [
-        ("circa " + (df["datetime"].dt.strftime("%Y"))),
-        df["datetime"].dt.strftime("%Y"),
-        df["datetime"].dt.strftime("%m/%Y"),
-        df["datetime"].dt.strftime("%d/%m/%Y"),
+        "circa " + year,
+        year,
+        month + "/" + year,
+        day + "/" + month + "/" + year,
     ]
-    df["Date"] = np.select(format_conditions, format_choices)
+    # ranges and other unrecognized dates are left empty
+    df["Date"] = np.select(format_conditions, format_choices, default=np.nan)
 
 
 def format_data(df):
@@ -208,40 +350,184 @@ def format_data(df):
     format_dates(df)
     extract_dimensions(df)
 
-    return df.filter(
-        items=[
-            "Document ID",
-            "Title",
-            "Creator",
-            "Description (Portuguese)",
-            "Date",
-            "First Year",
-            "Last Year",
-            "Type",
-            "Collection",
-            "Provider",
-            "Material",
-            "Fabrication Method",
-            "Rights",
-            "Required Statement",
-            "Width",
-            "Height",
-            "Document URL",
-            "Media URL",
-        ]
-    ).set_index("Document ID")
+    return df.filter(items=IMS_COLUMNS).set_index("Document ID")
+
+
+def parquet_path(path):
+    """
+    Columnar sibling of a CSV output
+    """
+    return os.path.splitext(path)[0] + ".parquet"
+
+
+def hash_ids(ids):
+    """
+    uint64 hashes of Document IDs, compact to hold for every record
+    """
+    return pd.util.hash_array(np.asarray(ids, dtype=object))
+
+
+def write_chunks(chunks, path, schema=FORMATTED_SCHEMA):
+    """
+    Write formatted chunks to the Parquet file at path as they come,
+    a row group each, replacing the previous file once all are written
+    """
+    tmp = f"{path}.tmp"
+    total = 0
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with pq.ParquetWriter(tmp, schema) as writer:
+        for chunk in chunks:
+            table = chunk.reset_index().astype(
+                {field.name: object for field in schema if field.type == pa.string()}
+            )
+            writer.write_table(
+                pa.Table.from_pandas(table, schema=schema, preserve_index=False)
+            )
+            total += len(chunk)
+            logger.debug(f"Wrote {total} IMS records")
+    os.replace(tmp, path)
+    logger.info(f"Wrote {total} IMS records to {path}")
+    return total
+
+
+class FingerprintStore:
+    """
+    Hash of the raw Cumulus fields of each record at the last ingest,
+    stored with its formatted row, so that unchanged records are read
+    back from the previous output instead of being formatted again.
+    Only hashes are held for every record, previous rows are read a
+    row group at a time. The output is kept apart from the dataset
+    later stages merge into
+    """
+
+    def __init__(self, output=IMS_FORMATTED, reformat=IMS_REFORMAT):
+        self._output = output
+        self._previous = None
+        hashes = np.empty(0, dtype="uint64")
+        ids = np.empty(0, dtype="uint64")
+        sizes = []
+        if reformat != "true" and os.path.exists(output):
+            # kept open, so it's still readable once the output is replaced
+            previous = pq.ParquetFile(output)
+            if "fingerprint" in previous.schema_arrow.names:
+                self._previous = previous
+                hashes = previous.read(columns=["fingerprint"]).column(0).to_numpy()
+                ids = np.concatenate(
+                    [ids]
+                    + [
+                        hash_ids(batch.column(0).to_numpy(zero_copy_only=False))
+                        for batch in previous.iter_batches(columns=["Document ID"])
+                    ]
+                )
+                sizes = [
+                    previous.metadata.row_group(i).num_rows
+                    for i in range(previous.num_row_groups)
+                ]
+                logger.info(f"Loaded {len(hashes)} record fingerprints from {output}")
+            else:
+                logger.warning(f"{output} has no fingerprints, reformatting all")
+
+        # sorted hashes -> rows of the previous output, first one first
+        self._rows = np.argsort(hashes, kind="stable")
+        self._hashes = hashes[self._rows]
+        self._sizes = np.array(sizes, dtype="int64")
+        self._ends = np.cumsum(self._sizes)
+        self._previous_ids = np.unique(ids)
+        self._ids = []
+        self._formatted = []
+
+    def read(self, rows):
+        """
+        Rows of the previous output, reading only the row groups holding them
+        """
+        groups = np.searchsorted(self._ends, rows, side="right")
+        needed = np.unique(groups)
+        table = self._previous.read_row_groups(needed.tolist(), columns=IMS_COLUMNS)
+        # where each row group starts in the file and in the table read
+        starts = self._ends - self._sizes
+        offsets = np.cumsum(self._sizes[needed]) - self._sizes[needed]
+        local = rows - starts[groups] + offsets[np.searchsorted(needed, groups)]
+        return table.take(local).to_pandas().set_index("Document ID")
+
+    def format(self, chunk):
+        """
+        Format a raw chunk, reusing the previous output for unchanged records
+        """
+        hashes = pd.util.hash_pandas_object(chunk, index=False).to_numpy()
+        positions = np.searchsorted(self._hashes, hashes)
+        unchanged = np.zeros(len(hashes), dtype=bool)
+        found = positions < len(self._hashes)
+        unchanged[found] = self._hashes[positions[found]] == hashes[found]
+
+        parts = []
+        if (~unchanged).any():
+            parts.append(format_data(chunk.loc[~unchanged].copy()))
+        if unchanged.any():
+            parts.append(self.read(self._rows[positions[unchanged]]))
+        order = np.argsort(
+            np.concatenate([np.flatnonzero(~unchanged), np.flatnonzero(unchanged)]),
+            kind="stable",
+        )
+        logger.debug(
+            f"Formatted {(~unchanged).sum()} records, reused {unchanged.sum()}"
+        )
+        formatted = pd.concat(parts).iloc[order]
+        formatted["fingerprint"] = hashes
+        self._ids.append(hash_ids(formatted.index))
+        self._formatted.append(formatted.index[~unchanged].to_numpy())
+        return formatted
+
+    def delta(self):
+        """
+        Document IDs of records added, changed or removed since the last ingest
+        """
+        current = np.unique(np.concatenate(self._ids or [[]]).astype("uint64"))
+        formatted = pd.Index(np.concatenate(self._formatted or [[]])).unique()
+        known = np.isin(hash_ids(formatted), self._previous_ids)
+        removed = set()
+        if self._previous is not None:
+            for batch in self._previous.iter_batches(columns=["Document ID"]):
+                ids = batch.column(0).to_numpy(zero_copy_only=False)
+                removed.update(ids[~np.isin(hash_ids(ids), current)])
+        return {
+            "new": sorted(formatted[~known]),
+            "changed": sorted(formatted[known]),
+            "removed": sorted(removed),
+        }
+
+    def save(self, delta_path=IMS_DELTA):
+        """
+        Write the delta, the fingerprints being stored with the output
+        """
+        delta = self.delta()
+        if self._previous is not None:
+            self._previous.close()
+        os.makedirs(os.path.dirname(delta_path) or ".", exist_ok=True)
+        with open(delta_path, "w", encoding="utf8") as f:
+            json.dump(delta, f, indent=4)
+        logger.info(
+            f"{len(delta['new'])} new, {len(delta['changed'])} changed and "
+            f"{len(delta['removed'])} removed IMS records"
+        )
+        return delta
 
 
 def main():
-    ims = xml_to_df(os.environ["CUMULUS_XML"])
-    ims = format_data(ims)
-    ims.to_csv(os.environ["IMS_METADATA"])
+    store = FingerprintStore()
+    chunks = iter_xml_chunks(os.environ["CUMULUS_XML"], IMS_CHUNKSIZE or None)
+    write_chunks(map(store.format, chunks), IMS_FORMATTED)
+    delta = store.save()
 
+    # streamed from the formatted output into the dataset once committed
+    merge = MetadataMerge(IMS_METADATA, source=IMS_FORMATTED)
     # if args.mode == "portals" or args.mode == "all":
-    query_portals()
+    urls = query_portals(delta["new"])
+    merge.submit(urls)
+    # records published since the last run have a new Document URL too
+    ids = set(delta["new"] + delta["changed"] + urls.attrs.get("mapped", []))
     # if args.mode == "images" or args.mode == "all":
-    pull_images()
-    ims2jstor()
+    merge.submit(pull_images(merge, ids))
+    ims2jstor(merge.commit(ids))
 
 
 if __name__ == "__main__":
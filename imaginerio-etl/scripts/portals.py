@@ -1,11 +1,19 @@
+import json
 import os
 import urllib
 
+import ijson
+import numpy as np
 import pandas as pd
 
-from ..utils.helpers import session, update_metadata
+from ..config import *
+from ..utils import network
+from ..utils.helpers import update_metadata
+from ..utils.logger import logger
 
 MAX_RETURNED = 55000
+# results fetched when searching for a single record
+MAX_MATCHES = 10
 
 
 def get_total_count():
@@ -21,56 +29,200 @@ def get_total_count():
     }
 
     params = urllib.parse.urlencode(payload, quote_via=urllib.parse.quote)
-    response = session.post(os.environ["PORTALS_API"], params=params)
+    response = network.post(os.environ["PORTALS_API"], params=params)
     data = response.json()
     return data["totalcount"]
 
 
-def query_portals(start_index):
+async def query_portals(start_index, size=MAX_RETURNED, search="jpg"):
     """
-    Returns dataframe with MAX_RETURNED items beggining at start_index.
+    Returns arrays of ids and record names of up to size items beggining
+    at start_index, in record ID order, parsed from the response as it
+    streams in
     """
 
     payload = {
         "table": "AssetRecords",
-        "quicksearchstring": "jpg",
-        "maxreturned": MAX_RETURNED,
+        "quicksearchstring": search,
+        "maxreturned": size,
         "startindex": start_index,
+        "sortby": PORTALS_SORT,
     }
 
     params = urllib.parse.urlencode(payload, quote_via=urllib.parse.quote)
-    # try:
-    response = session.post(os.environ["PORTALS_API"], params=params)
-    data = response.json()
-    portals = pd.json_normalize(data["items"])[["id", "RecordName"]]
-    portals.rename(
-        columns={"id": "Document URL", "RecordName": "Document ID"}, inplace=True
+
+    async def parse(response):
+        capacity = size
+        ids = np.empty(capacity, dtype=object)
+        names = np.empty(capacity, dtype=object)
+        count = -1
+        events = ijson.sendable_list()
+        parser = ijson.parse_coro(events)
+        async for chunk in response.aiter_bytes():
+            parser.send(chunk)
+            for prefix, event, value in events:
+                if prefix == "items.item" and event == "start_map":
+                    count += 1
+                    if count == capacity:
+                        capacity *= 2
+                        ids = np.resize(ids, capacity)
+                        names = np.resize(names, capacity)
+                elif prefix == "items.item.id":
+                    ids[count] = value
+                elif prefix == "items.item.RecordName":
+                    names[count] = value
+            del events[:]
+        parser.close()
+        return ids[: count + 1], names[: count + 1]
+
+    logger.debug(f"Querying portals from index {start_index}")
+    return await network.client.stream(
+        "POST", os.environ["PORTALS_API"], parse, params=params
+    )
+
+
+def to_frame(pages):
+    """
+    Document ID and URL of the items in a list of pages, first match first
+    """
+    empty = np.empty(0, dtype=object)
+    portals_df = pd.DataFrame(
+        {
+            "Document ID": np.concatenate([empty, *(names for _, names in pages)]),
+            "Document URL": np.concatenate([empty, *(ids for ids, _ in pages)]),
+        }
     )
-    portals["Document ID"] = portals["Document ID"].str.split(".", n=1, expand=True)[0]
-    portals["Document URL"] = os.environ["PORTALS_PREFIX"] + portals[
+    portals_df["Document ID"] = portals_df["Document ID"].str.split(".", n=1).str[0]
+    portals_df["Document URL"] = os.environ["PORTALS_PREFIX"] + portals_df[
         "Document URL"
     ].astype(str)
+    portals_df.drop_duplicates(subset="Document ID", inplace=True)
+    return portals_df.set_index("Document ID")
+
+
+def fetch(start_index, total_count):
+    """
+    Query every page from start_index on concurrently
+    """
+    return to_frame(
+        network.gather(
+            query_portals(start_index, min(MAX_RETURNED, total_count - start_index))
+            for start_index in range(start_index, total_count, MAX_RETURNED)
+        )
+    )
 
-    return portals
+
+def record_ids(urls):
+    """
+    Portals record IDs of the items in a Document ID -> Document URL frame
+    """
+    return pd.to_numeric(
+        urls["Document URL"].str.removeprefix(os.environ["PORTALS_PREFIX"]),
+        errors="coerce",
+    )
+
+
+def resolve(ids):
+    """
+    Search the portals for specific Document IDs
+    """
+    found = to_frame(network.gather(query_portals(0, MAX_MATCHES, id) for id in ids))
+    return found.loc[found.index.isin(ids)]
 
 
-def main():
-    start_index = 0
+class PortalsMap:
+    """
+    Persisted Document ID -> Document URL map, with the number
+    of published items it was last synced up to. Items are read in
+    record ID order, so new ones come after the cursor
+    """
+
+    def __init__(self, path=PORTALS):
+        self._path = path
+        self._state = os.path.splitext(path)[0] + ".json"
+        self.cursor = 0
+        # ids mapped to a new URL since loaded
+        self.mapped = set()
+        self.urls = pd.DataFrame(
+            {"Document URL": pd.Series(dtype=object)},
+            index=pd.Index([], name="Document ID", dtype=object),
+        )
+        if os.path.exists(path) and os.path.exists(self._state):
+            self.urls = pd.read_csv(path, dtype=str).set_index("Document ID")
+            with open(self._state, encoding="utf8") as f:
+                self.cursor = json.load(f)["cursor"]
+            logger.info(f"Loaded {len(self.urls)} portals URLs from {path}")
+
+    def __contains__(self, id):
+        return id in self.urls.index
+
+    def clear(self):
+        self.urls = self.urls.iloc[0:0]
+        self.cursor = 0
+
+    def merge(self, urls, since=None):
+        """
+        Add found URLs, replacing the ones already mapped. If urls holds
+        every published item from record ID since on, mapped items past
+        it that weren't found are dropped as unpublished
+        """
+        previous = self.urls["Document URL"].reindex(urls.index)
+        self.mapped.update(urls.index[previous.ne(urls["Document URL"])])
+        kept = ~self.urls.index.isin(urls.index)
+        if since is not None:
+            kept &= ~(record_ids(self.urls) >= since)
+        self.urls = pd.concat([self.urls[kept], urls])
+
+    def save(self):
+        os.makedirs(os.path.dirname(self._path) or ".", exist_ok=True)
+        self.urls.to_csv(self._path)
+        with open(self._state, "w", encoding="utf8") as f:
+            json.dump({"cursor": self.cursor}, f)
+
+
+def main(ids=None, resync=PORTALS_RESYNC):
+    """
+    Fetch items published since the last sync, or every item if resync
+    is "true", and search for any of ids still unmapped after that.
+    Returns the whole Document ID -> Document URL map, with the ids
+    mapped to a new URL in its "mapped" attribute
+    """
+    portals = PortalsMap()
     total_count = get_total_count()
-    portals_df = pd.DataFrame()
 
-    while start_index < total_count:
-        print("Querying portals from index {}".format(start_index))
-        portals_df = pd.concat(
-            [portals_df, query_portals(start_index)], ignore_index=True
+    if resync == "true" or total_count < portals.cursor:
+        # items were unpublished, indices before the cursor may have shifted
+        portals.clear()
+    start_index = max(0, portals.cursor - PORTALS_OVERLAP)
+    logger.info(f"Syncing portals items {start_index} to {total_count}")
+    synced = fetch(start_index, total_count)
+    found = record_ids(synced)
+    if not found.is_monotonic_increasing or found.isna().any():
+        logger.warning("Portals items weren't sorted by record ID, keeping all")
+        portals.merge(synced)
+    elif not found.empty:
+        portals.merge(synced, since=found.iloc[0])
+
+    # a full sync already read every published item
+    missing = [id for id in ids or [] if start_index and id not in portals]
+    if len(missing) > PORTALS_MAX_SEARCHES:
+        logger.warning(
+            f"{len(missing)} records unmapped, searching for the first "
+            f"{PORTALS_MAX_SEARCHES} only"
         )
-        start_index += MAX_RETURNED
+        missing = missing[:PORTALS_MAX_SEARCHES]
+    if missing:
+        logger.info(f"Searching portals for {len(missing)} unmapped records")
+        portals.merge(resolve(missing))
 
-    portals_df.drop_duplicates(subset="Document ID", inplace=True)
-    # portals_df.to_csv(os.environ["PORTALS"])
-    portals_df.set_index("Document ID", inplace=True)
-    update_metadata(portals_df)
+    portals.cursor = total_count
+    portals.save()
+    portals.urls.attrs["mapped"] = sorted(portals.mapped)
+    return portals.urls
 
 
 if __name__ == "__main__":
-    main()
+    try:
+        update_metadata(main())
+    finally:
+        network.close()
@@ -2,79 +2,169 @@ import argparse
 import os
 import re
 import sys
+from functools import partial
 
 import numpy as np
 import pandas as pd
-from tqdm import tqdm
-from tqdm.contrib.logging import logging_redirect_tqdm
 
-from ..entities.image import Highres, Image, Tif
+from ..config import *
+from ..entities.exiftool import ExifToolPool
+from ..entities.image import Image, Lowres, Tif, build_exiftool_args
 from ..utils.helpers import logger, update_metadata
+from ..utils.ledger import Ledger, versions
+from ..utils.merge import MetadataMerge
+from ..utils.pipeline import Pipeline, Stage
+from ..utils.scanner import Scanner, listdir, liststat, restat
 
 
-def get_images(metadata):
+def list_sources(restat_all=SOURCE_RESTAT):
     """
-    Walks directory tree and glob relevant files,
-    instantiating Image objects for each
+    Scans the source tree for relevant files, as
+    (path, size, mtime), along with the paths whose
+    stat comes from the manifest, unless restat_all
+    is "true" and every one is stat'ed again
     """
 
     source = os.environ["SOURCE"]
+    scanner = Scanner()
+    files = [
+        (path, size, mtime)
+        for path, size, mtime in scanner.scan(source)
+        if "FINALIZADAS" in os.path.dirname(path)
+        and path.endswith((".tif"))
+        and not re.search("[av]\.tif$", path)
+    ]
+    scanner.save()
+    stale = {path for path, _, _ in files if not scanner.listed(path)}
+    if restat_all == "true":
+        return refresh(files, stale), set()
+    return files, stale
+
+
+def refresh(files, paths):
+    """
+    files with the ones at paths stat'ed again,
+    leaving out those gone since they were listed
+    """
+    fresh = {file[0]: file for file in restat(paths)}
+    return [
+        fresh.get(file[0], file)
+        for file in files
+        if file[0] not in paths or file[0] in fresh
+    ]
+
+
+def image_id(path):
+    return os.path.basename(path).split(".")[0]
+
+
+def get_images(files, metadata, catalog, ledger, ids=None, stale=()):
+    """
+    Instantiates Image objects for files with the
+    stages the ledger says they need. metadata is a
+    DataFrame or a MetadataMerge to read the records
+    from, catalog has their ids. With ids, only files
+    of those records and the ones the ledger has
+    stages left for are kept. Files at stale paths
+    about to be handled are stat'ed again
+    """
+
+    work = ledger.pending(files, catalog)
+    if ids is not None:
+        work |= set(ids)
+        files = [file for file in files if image_id(file[0]) in work]
+        if isinstance(metadata, MetadataMerge):
+            metadata = metadata.records(catalog & work)
+    elif isinstance(metadata, MetadataMerge):
+        metadata = metadata.metadata
+    files = refresh(
+        files,
+        {path for path, _, _ in files if path in stale and image_id(path) in work},
+    )
+    tifs = liststat(os.environ["TIF"])
+    jpgs = listdir(os.environ["JPG"])
+    args = build_exiftool_args(metadata)
+    states = ledger.states(files, versions(args))
 
     images = [
-        Image(
-            os.path.join(root, name),
-            metadata,
-        )
-        for root, _, files in os.walk(source)
-        for name in files
-        if "FINALIZADAS" in root
-        and name.endswith((".tif"))
-        and not re.search("[av]\.tif$", name)
+        Image(path, metadata, tifs, jpgs, (size, mtime), args, states.get(path))
+        for path, size, mtime in files
     ]
 
     logger.debug(f"Listed {len(images)} images to process")
     return images
 
 
-def dispatch(image):
+def copy_tif(image):
+    """
+    Copy failsafe TIFs
+    """
+    image.copy_strategy(Tif())
+    logger.debug(f"Copied image {image.id}")
+    return image
+
+
+def convert_jpg(image):
     """
-    Copy failsafe TIFs, convert geolocated images
-    to JPG, and separate files for review and backlog
+    Convert geolocated images to JPG (copying the
+    TIF from the same read if it's missing too)
     """
+    image.copy_strategy()
+    logger.debug(f"Converted image {image.id}")
+    return image
 
-    if image.to_tif:
-        image.copy_strategy(Tif())
 
-    if image.to_jpg:
-        image.copy_strategy(Highres())
+def make_thumbnail(image):
+    """
+    Separate files for review and backlog
+    """
+    image.copy_strategy(Lowres())
+    return image
 
-    # if image.to_backlog or image.to_review:
-    #     image.copy_strategy(Lowres())
 
-    logger.debug(f"Dispatched image {image.id}")
+def embed_metadata(image, pool):
+    """
+    Embed catalog metadata with one of the pool's ExifTools
+    """
+    with pool.worker() as et:
+        image.embed_metadata(et)
+    # if not file_exists(image.id, "image"):
+    #     upload_file_to_s3(
+    #     os.path.join(os.environ["JPG"], image.jpg),
+    #     target="iiif/{0}/full/max/0/default.jpg".format(image.id),
+    #     mode=args.mode,
+    # )
+    # else:
+    #     logger.debug(f"{image.id} already in bucket")
     return image
 
 
-def create_images_df(images):
+def embed_metadata_batch(images):
+    """
+    Embed catalog metadata in a batch of images with one exiftool run
+    """
+    return Image.embed_metadata_batch(images)
+
+
+def create_images_df(ids, catalog):
     """
     Creates a dataframe with every image available and links to full size and thumbnail
     """
 
     prefix = os.environ["BUCKET"]
 
-    id = [img.id for img in images]
     url = {
         "Media URL": [
             (
-                os.path.join(prefix, "iiif", img.id, "full", "max", "0", "default.jpg")
+                os.path.join(prefix, "iiif", id, "full", "max", "0", "default.jpg")
                 # if img.is_geolocated
-                if img.in_catalog
+                if id in catalog
                 else np.nan
             )
-            for img in images
+            for id in ids
         ]
     }
-    images_df = pd.DataFrame(url, index=id)
+    images_df = pd.DataFrame(url, index=ids)
     images_df.drop_duplicates(inplace=True)
 
     logger.debug(f"{len(images_df)} images available in hi-res")
@@ -82,31 +172,73 @@ def create_images_df(images):
     return images_df
 
 
-def main():
-    metadata = pd.read_csv(os.environ["IMS_METADATA"], index_col="Document ID")
-    images = get_images(metadata)
-    images_df = create_images_df(images)
-
-    with logging_redirect_tqdm():
-        for image in tqdm(images, desc="Handling images"):
-            dispatch(image)
-            # if image.is_geolocated:
-            if image.in_catalog:
-                # image.get_metadata(metadata)
-                image.embed_metadata()
-                # if not file_exists(image.id, "image"):
-                #     upload_file_to_s3(
-                #     os.path.join(os.environ["JPG"], image.jpg),
-                #     target="iiif/{0}/full/max/0/default.jpg".format(image.id),
-                #     mode=args.mode,
-                # )
-                # else:
-                #     logger.debug(f"{image.id} already in bucket")
-            else:
-                continue
-
-    update_metadata(images_df)
-    # return images_df
+def main(metadata=None, ids=None):
+    """
+    Handle images and return the Media URLs of every one. metadata
+    is a DataFrame or a MetadataMerge. With ids, only images of those
+    records and ones the ledger has stages left for are handled
+    """
+    if metadata is None:
+        metadata = MetadataMerge()
+    catalog = set(
+        metadata.ids() if isinstance(metadata, MetadataMerge) else metadata.index
+    )
+    ledger = Ledger()
+    files, stale = list_sources()
+    images_df = create_images_df([image_id(path) for path, _, _ in files], catalog)
+    images = get_images(files, metadata, catalog, ledger, ids, stale)
+
+    if EXIFTOOL_BATCH:
+        # argfile batches run exiftool themselves
+        pool = ExifToolPool(0)
+        embed = embed_metadata_batch
+    else:
+        pool = ExifToolPool(EXIFTOOL_WORKERS)
+        embed = partial(embed_metadata, pool=pool)
+    stages = [
+        Stage(
+            "copied",
+            copy_tif,
+            PIPELINE_COPY_WORKERS,
+            when=lambda image: image.to_tif and not image.to_jpg,
+        ),
+        Stage(
+            "converted",
+            convert_jpg,
+            PIPELINE_CONVERT_WORKERS,
+            processes=True,
+            when=lambda image: image.to_jpg,
+        ),
+        # if image.is_geolocated:
+        Stage(
+            "embedded",
+            embed,
+            EXIFTOOL_WORKERS,
+            when=lambda image: image.in_catalog,
+            batch=EXIFTOOL_BATCH,
+        ),
+    ]
+    # thumbnails only where there are folders for them
+    if os.getenv("REVIEW") and os.getenv("BACKLOG"):
+        stages.append(
+            Stage(
+                "thumbnails",
+                make_thumbnail,
+                PIPELINE_CONVERT_WORKERS,
+                processes=True,
+                when=Lowres().outdated,
+            )
+        )
+    pipeline = Pipeline(stages, desc="Handling images")
+    with pool:
+        pipeline.run(images)
+    # failed images still have the stages before the failure done
+    ledger.record(pipeline.results + pipeline.failed)
+    ledger.close()
+    if pool.restarts:
+        logger.warning(f"Restarted {pool.restarts} crashed ExifTool processes")
+
+    return images_df
 
 
 if __name__ == "__main__":
@@ -116,4 +248,4 @@ if __name__ == "__main__":
     )
     args = parser.parse_args()
 
-    main()
+    update_metadata(main())
@@ -1,29 +1,59 @@
 import argparse
 import os
 
+import pandas as pd
+
 from ..config import *
-from ..utils.helpers import get_metadata_changes, summarize
+from ..utils import network
+from ..utils.helpers import commit_snapshot, get_metadata_changes, summarize
+from ..utils.journal import Journal, RetryQueue
 from ..utils.logger import logger
 from . import iiif, viewcones
 
 
 def main():
-    # Compare data, overwrite current data file if there are changes
+    # Compare data, the current data file is only overwritten once published
     all_data, changed_data = get_metadata_changes(CURRENT_JSTOR, NEW_JSTOR)
+    journal = Journal()
+    retry = RetryQueue()
 
     # Update viewcones if any
     if any(file for file in os.listdir(KMLS_IN) if file != ".gitkeep"):
-        viewcones_info = viewcones.update(all_data)
+        viewcones_info = viewcones.update(all_data.copy())
     else:
         logger.info("No KMLs to process, skipping")
         viewcones_info = None
 
-    # Update manifests if published items data has changed
-    if changed_data.empty:
+    # Add previously failed items that are due for another attempt
+    published = all_data.loc[all_data["Status"] == "In imagineRio"].drop(
+        columns=["Notes"]
+    )
+    retry_data = published.loc[
+        published.index.isin(retry.due()) & ~published.index.isin(changed_data.index)
+    ]
+    if not retry_data.empty:
+        logger.info(f"Retrying {len(retry_data)} previously failed items")
+    to_process = pd.concat([changed_data, retry_data])
+
+    # Regenerate every published manifest on demand, otherwise
+    # update manifests if published items data has changed
+    if REBUILD == "true":  # github action input, not boolean
+        manifest_info = iiif.rebuild(all_data, retry)
+    elif to_process.empty:
         logger.info("No metadata changes detected, exiting")
         manifest_info = None
     else:
-        manifest_info = iiif.update(changed_data)
+        manifest_info = iiif.update(to_process, journal, retry)
+
+    # Commit the new snapshot and drop the journal only after publishing
+    if manifest_info and manifest_info["published"]:
+        if not changed_data.empty:
+            commit_snapshot(all_data, CURRENT_JSTOR)
+        journal.clear()
+    elif manifest_info:
+        logger.warning("Collections weren't published, keeping journal for resume")
+    journal.close()
+    retry.save()
 
     if viewcones_info or manifest_info:
         summary = summarize(viewcones_info, manifest_info)
@@ -31,4 +61,7 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
+    try:
+        main()
+    finally:
+        network.close()
@@ -0,0 +1,146 @@
+import errno
+import hashlib
+import json
+import os
+import shutil
+
+from ..config import *
+from .logger import logger
+
+# files from this size on are copied by the kernel
+KERNEL_COPY_MIN = 2**20
+HASH_CHUNK = 2**24
+# errors meaning a copy method isn't available for these files
+UNSUPPORTED = (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP)
+
+
+def same_stat(source, copy, window=COPY_MODIFY_WINDOW):
+    """
+    Whether two (size, mtime_ns) pairs describe the same file, allowing
+    for filesystems that keep mtimes at a coarser resolution
+    """
+    return (
+        source is not None
+        and copy is not None
+        and source[0] == copy[0]
+        and abs(source[1] - copy[1]) <= window * 1e9
+    )
+
+
+def stat(path):
+    try:
+        result = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return result.st_size, result.st_mtime_ns
+
+
+def sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(HASH_CHUNK):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def identical(source, destination, verify=COPY_VERIFY):
+    """
+    Whether destination already is a complete copy of source. "stat"
+    compares size and mtime, "hash" relies on the sidecar written with
+    the copy, hashing the source only if its stat changed since
+    """
+    source_stat, copy_stat = stat(source), stat(destination)
+    if verify != "hash":
+        return same_stat(source_stat, copy_stat)
+
+    try:
+        with open(f"{destination}.sha256", encoding="utf8") as f:
+            sidecar = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return False
+    if not same_stat(tuple(sidecar["copy"]), copy_stat, window=0):
+        return False
+    return same_stat(tuple(sidecar["source"]), source_stat, window=0) or (
+        source_stat[0] == copy_stat[0] and sha256(source) == sidecar["sha256"]
+    )
+
+
+def kernel_copy(source, destination):
+    """
+    Copy file contents without passing them through userspace, with
+    copy_file_range (which lets the filesystem clone or copy server
+    side) or sendfile, falling back to a buffered copy
+    """
+    with open(source, "rb") as fsrc, open(destination, "wb") as fdst:
+        if os.fstat(fsrc.fileno()).st_size >= KERNEL_COPY_MIN:
+            for call in (
+                getattr(os, "copy_file_range", None),
+                lambda src, dst, count: os.sendfile(dst, src, None, count),
+            ):
+                if call is None:
+                    continue
+                try:
+                    while call(fsrc.fileno(), fdst.fileno(), 2**30):
+                        pass
+                    return
+                except OSError as e:
+                    if e.errno not in UNSUPPORTED:
+                        raise
+                    # start over with the next method
+                    fsrc.seek(0)
+                    fdst.seek(0)
+                    fdst.truncate()
+        shutil.copyfileobj(fsrc, fdst, HASH_CHUNK)
+
+
+def hashing_copy(source, destination):
+    """
+    Copy file contents through userspace, hashing them on the
+    way, returning the sha256
+    """
+    digest = hashlib.sha256()
+    with open(source, "rb") as fsrc, open(destination, "wb") as fdst:
+        while chunk := fsrc.read(HASH_CHUNK):
+            digest.update(chunk)
+            fdst.write(chunk)
+    return digest.hexdigest()
+
+
+def copy_file(source, destination, data=None, verify=COPY_VERIFY):
+    """
+    Copy source to destination unless it's already there, writing to a
+    temporary file renamed over destination once complete, so that an
+    interrupted copy is never mistaken for a finished one. data, if
+    given, holds source's contents already read. With "hash"
+    verification the contents are hashed as they're copied, into a
+    sidecar. Returns whether it copied
+    """
+    if identical(source, destination, verify):
+        logger.debug(f"{destination} is up to date")
+        return False
+
+    partial = f"{destination}.part"
+    digest = None
+    if data is not None:
+        with open(partial, "wb") as f:
+            f.write(data)
+        if verify == "hash":
+            digest = hashlib.sha256(data).hexdigest()
+    elif verify == "hash":
+        digest = hashing_copy(source, partial)
+    else:
+        kernel_copy(source, partial)
+    shutil.copystat(source, partial)
+    os.replace(partial, destination)
+
+    sidecar = f"{destination}.sha256"
+    if digest is None:
+        # one left by an earlier copy would describe another file
+        if os.path.exists(sidecar):
+            os.remove(sidecar)
+        return True
+    with open(sidecar, "w", encoding="utf8") as f:
+        json.dump(
+            {"sha256": digest, "source": stat(source), "copy": stat(destination)}, f
+        )
+    return True
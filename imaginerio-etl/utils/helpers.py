@@ -1,33 +1,31 @@
+import json
 import os
-import re
 import sys
-from datetime import datetime
+import threading
 from json import JSONDecodeError
 
 import boto3
 import pandas as pd
-import requests
 from iiif_prezi3 import Collection
 from pyproj import Proj
-from requests.adapters import HTTPAdapter
 from shapely.geometry import Point
-from SPARQLWrapper import JSON, SPARQLWrapper
-from urllib3.util import Retry
 
 from ..config import *
+from . import network
+from .invalidation import InvalidationManager
+from .inventory import Inventory
 from .logger import CustomFormatter as cf
 from .logger import logger
+from .merge import MetadataMerge
+from .ratelimit import BOTO_CONFIG, controller
+from .spreadsheet import read_excel, strip_id, write_excel
 
 # from lxml import etree
 
-s3_client = boto3.client("s3")
-
-session = requests.Session()
-retries = Retry(total=5, backoff_factor=1, status_forcelist=[502, 503, 504])
-session.mount("http://", HTTPAdapter(max_retries=retries))
-session.mount("https://", HTTPAdapter(max_retries=retries))
-
-float2str = lambda x: x.split(".")[0]
+s3_client = boto3.client("s3", config=BOTO_CONFIG)
+s3_client.meta.events.register("needs-retry.s3", controller.record_s3_retry)
+invalidations = InvalidationManager()
+inventory = Inventory()
 
 
 # def get_items(metadata, vocabulary):
@@ -35,24 +33,81 @@ float2str = lambda x: x.split(".")[0]
 
 
 def get_collections(metadata):  # , index
-    collections = {}
     # list all collection names
     labels = metadata["Collection"].dropna().str.split("|").explode().unique()
-    # create collection(s)
-    for label in labels:
-        # if index == "all":
-        #     collection = create_collection(label)
-        #     collections[label] = collection
-        # else:
-        try:
-            response = requests.get(
-                f"https://iiif.imaginerio.org/iiif/collection/{label.lower()}.json"
-            )
-            collection = Collection(**response.json())
-        except JSONDecodeError:
-            collection = create_collection(label)
-        collections[label] = collection
-    return collections
+    # existing collection(s) are revalidated concurrently up front
+    # and parsed only when used
+    paths = network.gather(fetch_collection(label) for label in labels)
+    return CollectionStore(dict(zip(labels, paths)))
+
+
+async def fetch_collection(label):
+    """
+    Download a collection unless the local copy is still current,
+    returning the local path or None if it doesn't exist yet
+    """
+    os.makedirs(COLLECTIONS_CACHE, exist_ok=True)
+    path = os.path.join(COLLECTIONS_CACHE, f"{label.lower()}.json")
+    etag_path = f"{path}.etag"
+    headers = {}
+    if os.path.exists(path) and os.path.exists(etag_path):
+        with open(etag_path) as f:
+            headers["If-None-Match"] = f.read()
+
+    response = await network.client.get(
+        f"{CLOUDFRONT}/collection/{label.lower()}.json", headers=headers
+    )
+    if response.status_code == 304:
+        logger.debug(f"Collection {label} unchanged, using local copy")
+        return path
+    if response.status_code != 200:
+        return None
+
+    with open(path, "wb") as f:
+        f.write(response.content)
+    if response.headers.get("ETag"):
+        with open(etag_path, "w") as f:
+            f.write(response.headers["ETag"])
+    elif os.path.exists(etag_path):
+        os.remove(etag_path)
+    return path
+
+
+class CollectionStore:
+    """
+    Collections keyed by label, parsed from their fetched local copy
+    the first time they're accessed. Only accessed collections are
+    listed by keys(), so untouched ones aren't uploaded again
+    """
+
+    def __init__(self, paths):
+        self._paths = paths
+        self._collections = {}
+        self._locks = {label: threading.Lock() for label in paths}
+
+    def __getitem__(self, label):
+        if label not in self._paths:
+            raise KeyError(label)
+        with self._locks[label]:
+            if label not in self._collections:
+                self._collections[label] = self.load(label)
+        return self._collections[label]
+
+    def __contains__(self, label):
+        return label in self._paths
+
+    def load(self, label):
+        path = self._paths[label]
+        if path:
+            try:
+                with open(path, encoding="utf8") as f:
+                    return Collection(**json.load(f))
+            except JSONDecodeError:
+                pass
+        return create_collection(label)
+
+    def keys(self):
+        return self._collections.keys()
 
 
 def get_metadata_changes(current_file, download_dir):
@@ -71,13 +126,22 @@ def get_metadata_changes(current_file, download_dir):
     changes = comparison.notna().any(axis=1)
     changed_data = filtered_new_data[changes]
 
-    # Replace current with new filtered data if any
-    if not changed_data.empty:
-        new_file = filtered_new_data.to_excel(current_file, engine="openpyxl")
-
     return new_data, changed_data
 
 
+def commit_snapshot(new_data, current_file):
+    """
+    Replace current with new filtered data, only called once
+    the changes have been published
+    """
+    filtered_new_data = new_data.drop(columns=["Notes"]).loc[
+        new_data["Status"] == "In imagineRio"
+    ]
+    write_excel(
+        filtered_new_data, current_file, headers=new_data.attrs.get("headers")
+    )
+
+
 def get_vocabulary(vocabulary_path):
     vocabulary = load_xls(vocabulary_path, "Label (en)")
     try:
@@ -115,6 +179,12 @@ def summarize(viewcones_info, manifests_info):
             f"items and created/updated {cf.GREEN}{manifests_info['n_manifests']}{cf.RESET} IIIF manifests. "
         )
 
+        if manifests_info.get("elapsed"):
+            summary += (
+                f"Took {manifests_info['elapsed']:.0f}s "
+                f"({manifests_info['n_items'] / manifests_info['elapsed']:.1f} items/s). "
+            )
+
         if manifests_info.get("no_collection"):
             summary += (
                 f"Items {cf.YELLOW}{manifests_info['no_collection']}{cf.RESET} aren't associated with any collections. "
@@ -127,6 +197,9 @@ def summarize(viewcones_info, manifests_info):
                 f"the images or metadata. Inspect the log above (with CTRL+F) for more details."
             )
 
+        if manifests_info.get("network"):
+            summary += manifests_info["network"]
+
     if viewcones_info:
         summary += (
             f"Items {cf.YELLOW}{viewcones_info['not_in_arcgis']}{cf.RESET} are marked as ready in JSTOR but have no viewcone. "
@@ -137,8 +210,8 @@ def summarize(viewcones_info, manifests_info):
 
 
 def load_xls(xls, index):
-    df = pd.read_excel(xls)
-    df.rename(columns=lambda x: re.sub(r"\[[0-9]*\]", "", x), inplace=True)
+    df = read_excel(xls)
+    df.rename(columns=strip_id, inplace=True)
     if "SSID" in df.columns:
         df["SSID"] = df["SSID"].astype(str)
     return df.set_index(index)
@@ -214,29 +287,18 @@ def file_exists(identifier, type):
     else:
         key = "iiif/{0}/full/max/0/default.jpg".format(identifier)
 
-    s3 = boto3.resource("s3")
-    bucket = s3.Bucket("imaginerio-images")
-    objs = list(bucket.objects.filter(Prefix=key))
-    if any([obj.key == key for obj in objs]):
-        return True
-    else:
-        return False
+    return inventory.exists(key)
 
 
 def invalidate_cache(path):
-    cloudfront = boto3.client("cloudfront")
-    get_timestamp = lambda x: datetime.timestamp(x)
-    cloudfront.create_invalidation(
-        DistributionId=DISTRIBUTION_ID,
-        InvalidationBatch={
-            "Paths": {"Quantity": 1, "Items": ["/" + path]},
-            "CallerReference": str(get_timestamp(datetime.now())),
-        },
-    )
+    manager = InvalidationManager()
+    manager.add(path)
+    manager.flush()
 
 
 def upload_folder_to_s3(source):
     logger.info(f"{cf.BLUE}Uploading {source} to S3...")
+    failed = []
     for root, _, files in os.walk(source):
         for file in files:
             try:
@@ -254,9 +316,13 @@ def upload_folder_to_s3(source):
                         )
                     },
                 )
+                invalidations.add(path)
+                inventory.add(path, os.path.getsize(path))
             except:
                 logger.error(f"{cf.RED}Failed to upload {path}")
-        # invalidate_cache(path)
+                failed.append(path)
+
+    return not failed
 
     # if mode == "test":
     #     return False
@@ -268,21 +334,30 @@ def upload_folder_to_s3(source):
 def upload_object_to_s3(obj, name, key):
     # logger.debug(f"{obj.id} -> {target}")
     try:
-        s3_client.put_object(
-            Body=obj.json(indent=4),
+        body = obj.json(indent=4)
+        response = s3_client.put_object(
+            Body=body,
             Bucket="imaginerio-images",
             Key=key,
             ContentType="application/json",
         )
         logger.info(f"{cf.GREEN}Object {name} uploaded successfully")
+        invalidations.add(key)
+        inventory.add(key, len(body.encode("utf-8")), response.get("ETag"))
+        return True
     except Exception as e:
         logger.error(f"{cf.RED}Failed to upload {name} to {key}: {e}")
+        return False
 
 
 def query_wikidata(Q):
     """
     Query Wikidata's SPARQL endpoint for entities' coordinates
     """
+    return network.client.run(query_wikidata_async(Q))
+
+
+async def query_wikidata_async(Q):
     endpoint_url = "https://query.wikidata.org/sparql"
 
     query = """SELECT ?coordinate
@@ -293,18 +368,20 @@ def query_wikidata(Q):
         Q
     )
 
-    def get_results(endpoint_url, query):
-        user_agent = "WDQS-example Python/%s.%s" % (
-            sys.version_info[0],
-            sys.version_info[1],
-        )
-        # TODO adjust user agent; see https://w.wiki/CX6
-        sparql = SPARQLWrapper(endpoint_url, agent=user_agent)
-        sparql.setQuery(query)
-        sparql.setReturnFormat(JSON)
-        return sparql.query().convert()
-
-    results = get_results(endpoint_url, query)
+    user_agent = "WDQS-example Python/%s.%s" % (
+        sys.version_info[0],
+        sys.version_info[1],
+    )
+    # TODO adjust user agent; see https://w.wiki/CX6
+    response = await network.client.get(
+        endpoint_url,
+        params={"query": query, "format": "json"},
+        headers={
+            "User-Agent": user_agent,
+            "Accept": "application/sparql-results+json",
+        },
+    )
+    results = response.json()
     result_list = []
     for result in results["results"]["bindings"]:
         if result:
@@ -325,37 +402,21 @@ def geo_to_world_coors(coors, inverse=False):
 
 
 def update_metadata(df):
-    metadata = pd.read_csv(
-        "data/output/faltantes.csv",
-        index_col="Document ID",
-        converters={
-            "First Year": float2str,
-            "Last Year": float2str,
-            "Width": float2str,
-            "Height": float2str,
-        },
-    )
-    print(metadata["Document URL"].dtype)
-    print("metadata", len(metadata))
-    metadata.update(df)
-    print("metadata after update", len(metadata))
-    metadata.to_csv("data/output/faltantes.csv")
-    # return metadata
+    merge = MetadataMerge()
+    merge.submit(df)
+    merge.commit()
 
 
-def ims2jstor():
-    jstor = pd.read_excel("data/input/jstor.xls")
+def ims2jstor(ims=None):
+    jstor = read_excel(CURRENT_JSTOR)
     jstor.set_index("Document ID[19474]", inplace=True)
-    ims = pd.read_csv(
-        "data/output/faltantes.csv",
-        index_col="Document ID",
-        converters={
-            "First Year": float2str,
-            "Last Year": float2str,
-            "Width": float2str,
-            "Height": float2str,
-        },
-    )
+    if ims is None:
+        ims = MetadataMerge().metadata
+    ims = ims.copy()
+    for dimension in ("Width", "Height"):
+        # whole millimeters
+        whole = (ims[dimension] // 1).astype("Int64")
+        ims[dimension] = whole.astype(str).where(whole.notna())
     print("ims", len(ims))
     # digitized = ims["Media URL"].notna()
     published = ims["Document URL"].notna()
@@ -393,4 +454,4 @@ def ims2jstor():
     ] = ""
     ims2jstor["SSID"] = "NEW"
     ims2jstor.index.rename("Document ID[19474]", inplace=True)
-    ims2jstor.to_excel("data/output/ims2jstor.xls", engine="openpyxl")
+    write_excel(ims2jstor, "data/output/ims2jstor.xls")
@@ -0,0 +1,136 @@
+import threading
+from datetime import datetime
+
+import boto3
+
+from ..config import *
+from .logger import CustomFormatter as cf
+from .logger import logger
+from .ratelimit import BOTO_CONFIG
+
+# CloudFront limits: paths per invalidation batch and
+# wildcard paths allowed in progress at the same time
+MAX_PATHS = 3000
+MAX_WILDCARDS = 15
+# Shallowest prefix collapsed by default, i.e. iiif/<id>/*
+MIN_DEPTH = 2
+
+
+class LocalInvalidationClient:
+    """
+    Stand-in for the CloudFront client that records
+    invalidation batches instead of submitting them
+    """
+
+    def __init__(self):
+        self.batches = []
+
+    def create_invalidation(self, DistributionId, InvalidationBatch):
+        paths = InvalidationBatch["Paths"]["Items"]
+        self.batches.append(paths)
+        logger.debug(f"Would invalidate {len(paths)} paths: {paths}")
+        return {"Invalidation": {"Id": f"local-{len(self.batches)}"}}
+
+
+class InvalidationManager:
+    """
+    Collect every key published during a run and invalidate
+    them at once, collapsing directories into wildcard paths
+    """
+
+    def __init__(self, distribution_id=DISTRIBUTION_ID, client=None):
+        self._distribution_id = distribution_id
+        self._client = client
+        self._keys = set()
+        self._lock = threading.Lock()
+
+    @property
+    def client(self):
+        if self._client is None:
+            if self._distribution_id:
+                self._client = boto3.client("cloudfront", config=BOTO_CONFIG)
+            else:
+                logger.warning("DISTRIBUTION_ID not set, invalidations won't be sent")
+                self._client = LocalInvalidationClient()
+        return self._client
+
+    def add(self, key):
+        with self._lock:
+            self._keys.add(key.lstrip("/"))
+
+    def update(self, keys):
+        with self._lock:
+            self._keys.update(key.lstrip("/") for key in keys)
+
+    def drain(self):
+        """
+        Return and forget the collected keys, used to hand
+        them over from worker processes
+        """
+        with self._lock:
+            keys, self._keys = self._keys, set()
+        return keys
+
+    def paths(self):
+        """
+        Collapse keys sharing a directory into a wildcard, climbing to
+        shallower directories while there are too many paths or wildcards
+        for a single invalidation, up to invalidating everything
+        """
+        depth = MIN_DEPTH
+        paths = collapse(self._keys, depth)
+        while depth > 0 and (
+            len(paths) > MAX_PATHS
+            or sum(path.endswith("*") for path in paths) > MAX_WILDCARDS
+        ):
+            depth -= 1
+            paths = collapse(self._keys, depth)
+        return sorted(paths)
+
+    def flush(self):
+        """
+        Submit the collected keys as one invalidation, which paths()
+        keeps within what CloudFront allows in progress at once
+        """
+        with self._lock:
+            if not self._keys:
+                return []
+            paths = self.paths()
+            self._keys = set()
+
+        timestamp = datetime.timestamp(datetime.now())
+        try:
+            self.client.create_invalidation(
+                DistributionId=self._distribution_id,
+                InvalidationBatch={
+                    "Paths": {"Quantity": len(paths), "Items": paths},
+                    "CallerReference": f"{timestamp}",
+                },
+            )
+        except Exception as e:
+            logger.error(f"{cf.RED}Failed to invalidate {len(paths)} paths: {e}")
+            return []
+        logger.info(f"Invalidated {len(paths)} CloudFront paths")
+        return paths
+
+
+def collapse(keys, depth):
+    """
+    Replace keys sharing their first `depth` segments with a single wildcard,
+    depth 0 being the whole distribution
+    """
+    if depth == 0:
+        return ["/*"]
+    groups = {}
+    for key in keys:
+        parts = key.split("/")
+        prefix = "/".join(parts[:depth]) if len(parts) > depth else None
+        groups.setdefault(prefix, []).append(key)
+
+    paths = []
+    for prefix, members in groups.items():
+        if prefix is not None and len(members) > 1:
+            paths.append(f"/{prefix}/*")
+        else:
+            paths.extend(f"/{key}" for key in members)
+    return paths
@@ -0,0 +1,143 @@
+import os
+import threading
+import time
+
+import boto3
+import pandas as pd
+
+from ..config import *
+from .logger import CustomFormatter as cf
+from .logger import logger
+from .ratelimit import BOTO_CONFIG
+
+
+class Inventory:
+    """
+    In-memory index of the bucket's objects under a prefix, listed
+    once per run or loaded from a cached inventory file, answering
+    existence, size and ETag queries without further requests
+    """
+
+    def __init__(
+        self,
+        bucket="imaginerio-images",
+        prefix="iiif/",
+        path=INVENTORY,
+        max_age=INVENTORY_MAX_AGE,
+        client=None,
+    ):
+        self._bucket = bucket
+        self._prefix = prefix
+        self._path = path
+        self._max_age = max_age
+        self._client = client
+        self._objects = None
+        self._pending = {}
+        self._added = {}
+        self._lock = threading.RLock()
+
+    @property
+    def objects(self):
+        if self._objects is None:
+            with self._lock:
+                if self._objects is None:
+                    self.load()
+        return self._objects
+
+    def load(self):
+        """
+        Read the cached inventory if it's recent enough, otherwise list the bucket
+        """
+        if (
+            os.path.exists(self._path)
+            and time.time() - os.path.getmtime(self._path) < self._max_age * 3600
+        ):
+            df = pd.read_parquet(self._path)
+            objects = dict(zip(df["key"], zip(df["size"], df["etag"])))
+            logger.info(f"Loaded {len(objects)} objects from {self._path}")
+            listed = False
+        else:
+            objects = self.list_bucket()
+            listed = True
+        objects.update(self._pending)
+        self._pending = {}
+        self._objects = objects
+        if listed:
+            self.save()
+
+    def list_bucket(self):
+        logger.info(f"{cf.BLUE}Listing s3://{self._bucket}/{self._prefix}...")
+        client = self._client or boto3.client("s3", config=BOTO_CONFIG)
+        paginator = client.get_paginator("list_objects_v2")
+        objects = {}
+        for page in paginator.paginate(Bucket=self._bucket, Prefix=self._prefix):
+            for obj in page.get("Contents", []):
+                objects[obj["Key"]] = (obj["Size"], obj["ETag"])
+        logger.info(f"Listed {len(objects)} objects")
+        return objects
+
+    def save(self):
+        """
+        Write the inventory to the cache file, or merge the objects
+        recorded without a prior load into the existing one
+        """
+        with self._lock:
+            if self._objects is None:
+                if not self._pending or not os.path.exists(self._path):
+                    return
+                df = pd.read_parquet(self._path)
+                objects = dict(zip(df["key"], zip(df["size"], df["etag"])))
+                objects.update(self._pending)
+                mtime = os.path.getmtime(self._path)
+            else:
+                objects = dict(self._objects)
+                mtime = None
+            self._pending = {}
+        keys = list(objects)
+        sizes, etags = zip(*objects.values()) if keys else ((), ())
+        os.makedirs(os.path.dirname(self._path) or ".", exist_ok=True)
+        tmp = f"{self._path}.tmp"
+        pd.DataFrame({"key": keys, "size": sizes, "etag": etags}).to_parquet(
+            tmp, index=False
+        )
+        os.replace(tmp, self._path)
+        if mtime:
+            # merging doesn't make the listing any fresher
+            os.utime(self._path, (mtime, mtime))
+
+    def add(self, key, size=None, etag=None):
+        """
+        Record an object uploaded during the run
+        """
+        with self._lock:
+            target = self._pending if self._objects is None else self._objects
+            target[key] = (size, etag)
+            self._added[key] = (size, etag)
+
+    def update(self, objects):
+        """
+        Record objects uploaded by another process
+        """
+        for key, (size, etag) in objects.items():
+            self.add(key, size, etag)
+
+    def drain(self):
+        """
+        Return the objects recorded since the last call, so worker
+        processes can hand their uploads back to the parent
+        """
+        with self._lock:
+            added, self._added = self._added, {}
+        return added
+
+    def exists(self, key):
+        return key in self.objects
+
+    def size(self, key):
+        return self.objects.get(key, (None, None))[0]
+
+    def etag(self, key):
+        return self.objects.get(key, (None, None))[1]
+
+    def __contains__(self, key):
+        return self.exists(key)
@@ -0,0 +1,122 @@
+import hashlib
+import json
+import os
+import threading
+from datetime import datetime, timedelta
+
+from ..config import *
+from .logger import CustomFormatter as cf
+from .logger import logger
+
+
+def fingerprint(row):
+    """
+    Hash an item's metadata so journal entries are only reused
+    while the row they were recorded for is unchanged
+    """
+    return hashlib.sha1(row.to_json().encode("utf-8")).hexdigest()
+
+
+class Journal:
+    """
+    Append-only log of per-item stage completion (downloaded, tiled,
+    uploaded, published), one JSON object per line, so an interrupted
+    run can resume where it stopped
+    """
+
+    def __init__(self, path=JOURNAL):
+        self._path = path
+        self._entries = {}
+        if os.path.exists(path):
+            with open(path, encoding="utf8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        # last line of a run killed mid-write
+                        continue
+                    self._entries[(entry["id"], entry["stage"])] = entry
+            logger.info(f"Loaded {len(self._entries)} journal entries from {path}")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._file = open(path, "a", encoding="utf8")
+        self._lock = threading.Lock()
+
+    def done(self, id, stage, stamp):
+        entry = self._entries.get((id, stage))
+        return entry is not None and entry["fingerprint"] == stamp
+
+    def get(self, id, stage, stamp):
+        return self._entries.get((id, stage)) if self.done(id, stage, stamp) else None
+
+    def record(self, id, stage, stamp, **data):
+        entry = {
+            "id": id,
+            "stage": stage,
+            "fingerprint": stamp,
+            "time": datetime.now().isoformat(),
+            **data,
+        }
+        with self._lock:
+            self._entries[(id, stage)] = entry
+            self._file.write(json.dumps(entry) + "\n")
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def clear(self):
+        """
+        Drop every entry once the run's work is committed
+        """
+        with self._lock:
+            self._entries = {}
+            self._file.seek(0)
+            self._file.truncate()
+
+    def close(self):
+        self._file.close()
+
+
+class RetryQueue:
+    """
+    Persisted set of failed item ids, retried with exponential
+    backoff on later runs until they succeed
+    """
+
+    def __init__(self, path=RETRY_QUEUE):
+        self._path = path
+        try:
+            with open(path, encoding="utf8") as f:
+                self._queue = json.load(f)
+        except FileNotFoundError:
+            self._queue = {}
+
+    def __contains__(self, id):
+        return id in self._queue
+
+    def due(self, now=None):
+        now = now or datetime.now()
+        return [
+            id
+            for id, entry in self._queue.items()
+            if datetime.fromisoformat(entry["next_attempt"]) <= now
+        ]
+
+    def fail(self, id):
+        attempts = self._queue.get(id, {}).get("attempts", 0) + 1
+        delay = min(RETRY_BACKOFF * 2 ** (attempts - 1), RETRY_MAX_BACKOFF)
+        next_attempt = datetime.now() + timedelta(hours=delay)
+        self._queue[id] = {
+            "attempts": attempts,
+            "next_attempt": next_attempt.isoformat(),
+        }
+        logger.warning(
+            f"{cf.YELLOW}Item {id} failed {attempts} time(s), "
+            f"will retry after {next_attempt:%Y-%m-%d %H:%M}"
+        )
+
+    def succeed(self, id):
+        self._queue.pop(id, None)
+
+    def save(self):
+        os.makedirs(os.path.dirname(self._path), exist_ok=True)
+        with open(self._path, "w", encoding="utf8") as f:
+            json.dump(self._queue, f, indent=4)
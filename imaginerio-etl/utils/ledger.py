@@ -0,0 +1,183 @@
+import hashlib
+import json
+import os
+import sqlite3
+
+from ..config import *
+from .copier import sha256
+from .logger import logger
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS images (
+    id TEXT PRIMARY KEY,
+    size INTEGER,
+    mtime INTEGER,
+    sha256 TEXT,
+    copied INTEGER DEFAULT 0,
+    converted INTEGER DEFAULT 0,
+    embedded TEXT,
+    uploaded INTEGER DEFAULT 0
+)
+"""
+
+
+def versions(args):
+    """
+    Hash of each record's ExifTool arguments, so that JPGs are embedded
+    again when their catalog metadata changes
+    """
+    return args.map(lambda params: hashlib.sha1(b"\n".join(params)).hexdigest())
+
+
+def copy_hash(tif, source):
+    """
+    The sha256 recorded in a TIF copy's sidecar, if it was
+    made from source as it is now
+    """
+    try:
+        with open(f"{tif}.sha256", encoding="utf8") as f:
+            sidecar = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+    return sidecar["sha256"] if tuple(sidecar["source"]) == source else None
+
+
+class Ledger:
+    """
+    SQLite record of each image's source (size, mtime and, with hash
+    verification, the sha256 of its last copy) and of the pull stages
+    done for it, so that the work of a run is one query away instead of
+    inferred from which files exist. A source whose size or mtime
+    changed has every stage done again, unless its content hashes the
+    same as recorded. A failed embedding is recorded as an empty
+    version, which no metadata version matches
+    """
+
+    def __init__(self, path=LEDGER):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._db = sqlite3.connect(path)
+        self._db.execute(SCHEMA)
+        self._sources = {}
+        self._versions = {}
+        self._digests = {}
+
+    def load(self, files, versions):
+        """
+        Fill the temporary tables files (path, size, mtime) and catalog
+        versions are joined from, returning the files by id
+        """
+        sources = {
+            os.path.basename(path).split(".")[0]: (path, size, mtime)
+            for path, size, mtime in files
+        }
+        self._db.execute("DROP TABLE IF EXISTS temp.scan")
+        self._db.execute("CREATE TEMP TABLE scan (id TEXT, path TEXT, size, mtime)")
+        self._db.executemany(
+            "INSERT INTO scan VALUES (?, ?, ?, ?)",
+            [(id, *source) for id, source in sources.items()],
+        )
+        self._db.execute("DROP TABLE IF EXISTS temp.catalog")
+        self._db.execute("CREATE TEMP TABLE catalog (id TEXT PRIMARY KEY, version)")
+        self._db.executemany("INSERT INTO catalog VALUES (?, ?)", versions.items())
+        return sources
+
+    def pending(self, files, catalog):
+        """
+        Ids of files (path, size, mtime) with stages left as far as the
+        ledger knows, without looking catalog records up: unknown or
+        changed since recorded, not copied, or not converted or embedded
+        if in catalog
+        """
+        self.load(files, dict.fromkeys(catalog))
+        rows = self._db.execute("""
+            SELECT s.id
+            FROM scan s
+            LEFT JOIN images l ON l.id = s.id
+            LEFT JOIN catalog c ON c.id = s.id
+            WHERE l.id IS NULL
+                OR s.size IS NOT l.size
+                OR s.mtime IS NOT l.mtime
+                OR NOT l.copied
+                OR (c.id IS NOT NULL AND (NOT l.converted OR l.embedded = ''))
+            """)
+        return {id for id, in rows}
+
+    def states(self, files, versions):
+        """
+        Stages each of files (path, size, mtime) still needs, by path, as
+        to_tif, to_jpg and to_embed flags. versions has the current
+        metadata version of catalog ids. Files the ledger doesn't know
+        are left out, to be checked on disk
+        """
+        self._versions = versions
+        self._sources = self.load(files, versions)
+
+        rows = self._db.execute("""
+            SELECT s.id, s.path, s.size = l.size, s.mtime = l.mtime, l.sha256,
+                   l.copied, l.converted, l.embedded IS c.version
+            FROM scan s
+            JOIN images l ON l.id = s.id
+            LEFT JOIN catalog c ON c.id = s.id
+            """)
+        states = {}
+        for id, path, same_size, same_mtime, digest, *done in rows:
+            copied, converted, current = done
+            unchanged = same_size and same_mtime
+            if same_size and not same_mtime and digest:
+                # touched but not modified
+                unchanged = sha256(path) == digest
+            if unchanged and digest:
+                self._digests[id] = digest
+            states[path] = {
+                "to_tif": not (unchanged and copied),
+                "to_jpg": not (unchanged and converted),
+                "to_embed": not (unchanged and current),
+            }
+        changed = sum(state["to_tif"] for state in states.values())
+        logger.debug(
+            f"Ledger knows {len(states)} of {len(self._sources)} images, "
+            f"{changed} of them to copy again"
+        )
+        return states
+
+    def record(self, images):
+        """
+        Record the stages done for images, before or during this run, as
+        of the source stat and metadata versions passed to states
+        """
+        rows = []
+        for image in images:
+            path, size, mtime = self._sources[image.id]
+            digest = copy_hash(
+                os.path.join(os.environ["TIF"], image.tif), (size, mtime)
+            ) or self._digests.get(image.id)
+            copied = not image.to_tif or "copied" in image.done
+            converted = image.in_catalog and (
+                not image.to_jpg or "converted" in image.done
+            )
+            if not image.in_catalog:
+                embedded = None
+            elif image.embedded or not image.metadata:
+                embedded = self._versions.get(image.id)
+            else:
+                embedded = ""
+            rows.append((image.id, size, mtime, digest, copied, converted, embedded))
+        with self._db:
+            self._db.executemany(
+                """
+                INSERT INTO images (id, size, mtime, sha256, copied, converted, embedded)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (id) DO UPDATE SET
+                    size = excluded.size,
+                    mtime = excluded.mtime,
+                    sha256 = excluded.sha256,
+                    copied = excluded.copied,
+                    converted = excluded.converted,
+                    embedded = excluded.embedded
+                """,
+                rows,
+            )
+        logger.debug(f"Recorded {len(rows)} images in the ledger")
+
+    def close(self):
+        self._db.close()
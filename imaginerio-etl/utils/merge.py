@@ -0,0 +1,146 @@
+import os
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from ..config import *
+from .logger import logger
+
+
+class MetadataMerge:
+    """
+    IMS dataset updated with the partial frames (keyed by Document ID)
+    each stage submits and written once, as Parquet plus a CSV export.
+    Records are streamed from source (the Parquet output itself by
+    default) a row group at a time with the updates applied, so the
+    whole dataset is only held in memory when asked for
+    """
+
+    def __init__(self, path=IMS_METADATA, source=None):
+        self._path = path
+        self._parquet = os.path.splitext(path)[0] + ".parquet"
+        self._source = source or self._parquet
+        self._updates = []
+        self._metadata = None
+
+    @property
+    def metadata(self):
+        if self._metadata is None:
+            self._metadata = self.records()
+            logger.info(f"Loaded {len(self._metadata)} IMS records")
+        return self._metadata
+
+    def schema(self):
+        """
+        Arrow schema of the source's records, without the formatted
+        output's fingerprints
+        """
+        schema = pq.read_schema(self._source)
+        if "fingerprint" in schema.names:
+            schema = schema.remove(schema.get_field_index("fingerprint"))
+        return schema
+
+    def batches(self, columns=None):
+        """
+        Source records a row group at a time, indexed by Document ID, or
+        all at once from the CSV output if there's no Parquet source
+        """
+        if not os.path.exists(self._source):
+            df = pd.read_csv(self._path, dtype=str, usecols=columns)
+            dimensions = [column for column in ("Width", "Height") if column in df]
+            yield df.astype(dict.fromkeys(dimensions, float)).set_index("Document ID")
+            return
+        schema = self.schema()
+        columns = columns or schema.names
+        with pq.ParquetFile(self._source) as f:
+            if not f.num_row_groups:
+                yield schema.empty_table().select(columns).to_pandas().set_index(
+                    "Document ID"
+                )
+            for i in range(f.num_row_groups):
+                yield f.read_row_group(i, columns=columns).to_pandas().set_index(
+                    "Document ID"
+                )
+
+    def ids(self):
+        """
+        Document IDs of the dataset, reading nothing else
+        """
+        return pd.Index(
+            pd.concat(
+                batch.index.to_series() for batch in self.batches(["Document ID"])
+            ),
+            name="Document ID",
+        )
+
+    def apply(self, batch):
+        """
+        Overwrite a batch's values with the non-null ones submitted,
+        for the records and columns both have
+        """
+        for df in self._updates:
+            columns = batch.columns.intersection(df.columns)
+            other = df[columns].reindex(batch.index)
+            for column in columns:
+                batch[column] = other[column].where(
+                    other[column].notna(), batch[column]
+                )
+        return batch
+
+    def records(self, ids=None):
+        """
+        Merged records in ids, every one if None
+        """
+        return pd.concat(
+            self.apply(batch if ids is None else batch[batch.index.isin(ids)])
+            for batch in self.batches()
+        )
+
+    def submit(self, df):
+        """
+        Queue df's values to be merged as records are read
+        """
+        self._updates.append(df[~df.index.duplicated()])
+        self._metadata = None
+
+    def commit(self, ids=None):
+        """
+        Stream the merged dataset into its outputs if any stage submitted
+        changes or it's read from another source, returning the records
+        in ids (every one if None)
+        """
+        if not self._updates and self._source == self._parquet:
+            return self.records(ids)
+        schema = self.schema() if os.path.exists(self._source) else None
+        tmp = f"{self._parquet}.tmp"
+        csv_tmp = f"{self._path}.tmp"
+        writer = None
+        kept = []
+        for batch in self.batches():
+            batch = self.apply(batch)
+            if writer is None:
+                batch.to_csv(csv_tmp)
+                if schema is None:
+                    schema = pa.Schema.from_pandas(
+                        batch.reset_index(), preserve_index=False
+                    )
+                writer = pq.ParquetWriter(tmp, schema)
+            else:
+                batch.to_csv(csv_tmp, mode="a", header=False)
+            # all-null columns of a batch must keep the dataset's types
+            table = batch.reset_index().astype(
+                {field.name: object for field in schema if field.type == pa.string()}
+            )
+            writer.write_table(
+                pa.Table.from_pandas(table, schema=schema, preserve_index=False)
+            )
+            kept.append(batch if ids is None else batch[batch.index.isin(ids)])
+        writer.close()
+        os.replace(tmp, self._parquet)
+        os.replace(csv_tmp, self._path)
+        logger.info(f"Merged {len(self._updates)} updates into {self._path}")
+        self._source = self._parquet
+        self._updates = []
+        self._metadata = None
+        return pd.concat(kept)
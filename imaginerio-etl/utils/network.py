@@ -0,0 +1,188 @@
+import asyncio
+import os
+import threading
+from urllib.parse import urlsplit
+
+import httpx
+
+from ..config import *
+from .logger import logger
+from .ratelimit import controller
+
+
+class Client:
+    """
+    Async HTTP client shared by every network helper. Keeps a pool of
+    keep-alive connections per host, paces requests through the
+    per-host rate controller and retries failed requests with
+    exponential backoff. Synchronous code runs coroutines through
+    run(), which schedules them on a background event loop
+    """
+
+    def __init__(
+        self,
+        retries=5,
+        backoff_factor=1,
+        status_forcelist=(429, 502, 503, 504),
+        connections_per_host=HTTP_CONNECTIONS_PER_HOST,
+        timeout=HTTP_TIMEOUT,
+        limits=controller,
+    ):
+        self._retries = retries
+        self._backoff_factor = backoff_factor
+        self._status_forcelist = status_forcelist
+        self._controller = limits
+        self._limits = httpx.Limits(
+            max_connections=connections_per_host,
+            max_keepalive_connections=connections_per_host,
+            keepalive_expiry=30,
+        )
+        self._timeout = httpx.Timeout(timeout, connect=10)
+        self._pools = {}
+        self._loop = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    @property
+    def loop(self):
+        """
+        Background event loop, started on first use in each process
+        """
+        with self._lock:
+            if self._loop is None or self._pid != os.getpid():
+                self._loop = asyncio.new_event_loop()
+                self._pools = {}
+                self._pid = os.getpid()
+                threading.Thread(
+                    target=self._loop.run_forever, name="network", daemon=True
+                ).start()
+        return self._loop
+
+    def pool(self, url):
+        host = urlsplit(url).netloc
+        key = (id(asyncio.get_running_loop()), host)
+        if key not in self._pools:
+            self._pools[key] = httpx.AsyncClient(
+                limits=self._limits, timeout=self._timeout, follow_redirects=True
+            )
+        return self._pools[key]
+
+    def backoff(self, attempt, response=None):
+        if response is not None and status(response)[1]:
+            # the host limiter already pauses for Retry-After
+            return 0
+        return min(self._backoff_factor * 2**attempt, 120)
+
+    async def request(self, method, url, **kwargs):
+        limiter = self._controller.limiter(urlsplit(url).netloc)
+        for attempt in range(self._retries + 1):
+            response = None
+            await limiter.acquire()
+            try:
+                response = await self.pool(url).request(method, url, **kwargs)
+            except httpx.TransportError as e:
+                if attempt == self._retries:
+                    raise
+                logger.debug(f"{method} {url} failed ({e}), retrying")
+            finally:
+                limiter.release(*status(response))
+            if response is not None and (
+                response.status_code not in self._status_forcelist
+                or attempt == self._retries
+            ):
+                return response
+            await asyncio.sleep(self.backoff(attempt, response))
+
+    async def stream(self, method, url, consume, **kwargs):
+        """
+        Like request(), but hands the open response to the consume
+        coroutine, which reads the body as it arrives. Retried
+        attempts call consume again from the start
+        """
+        limiter = self._controller.limiter(urlsplit(url).netloc)
+        for attempt in range(self._retries + 1):
+            response = None
+            await limiter.acquire()
+            try:
+                async with self.pool(url).stream(method, url, **kwargs) as response:
+                    if (
+                        response.status_code not in self._status_forcelist
+                        or attempt == self._retries
+                    ):
+                        return await consume(response)
+            except httpx.TransportError as e:
+                if attempt == self._retries:
+                    raise
+                logger.debug(f"{method} {url} failed ({e}), retrying")
+            finally:
+                limiter.release(*status(response))
+            await asyncio.sleep(self.backoff(attempt, response))
+
+    async def get(self, url, **kwargs):
+        return await self.request("GET", url, **kwargs)
+
+    async def post(self, url, **kwargs):
+        return await self.request("POST", url, **kwargs)
+
+    def close(self):
+        """
+        Close the connection pools opened on this process' loop
+        """
+        with self._lock:
+            if self._loop is None or self._pid != os.getpid():
+                return
+            loop = self._loop
+
+        async def close():
+            key = id(loop)
+            pools = [pool for (k, _), pool in self._pools.items() if k == key]
+            self._pools = {k: v for k, v in self._pools.items() if k[0] != key}
+            await asyncio.gather(*(pool.aclose() for pool in pools))
+
+        asyncio.run_coroutine_threadsafe(close(), loop).result()
+
+    def run(self, coro):
+        """
+        Run a coroutine on the client's loop from synchronous code.
+        Must not be called from a coroutine already running on it
+        """
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    def gather(self, coros):
+        """
+        Run coroutines concurrently, returning their results in order
+        """
+
+        async def gather():
+            return await asyncio.gather(*coros)
+
+        return self.run(gather())
+
+
+def status(response):
+    """
+    Status code and Retry-After seconds to report to the host limiter
+    """
+    if response is None:
+        return None, None
+    retry_after = response.headers.get("Retry-After", "")
+    return response.status_code, int(retry_after) if retry_after.isdigit() else None
+
+
+client = Client()
+
+
+def get(url, **kwargs):
+    return client.run(client.get(url, **kwargs))
+
+
+def post(url, **kwargs):
+    return client.run(client.post(url, **kwargs))
+
+
+def gather(coros):
+    return client.gather(coros)
+
+
+def close():
+    client.close()
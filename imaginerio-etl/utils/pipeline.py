@@ -0,0 +1,164 @@
+import multiprocessing
+import queue
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from tqdm import tqdm
+from tqdm.contrib.logging import logging_redirect_tqdm
+
+from ..config import *
+from .logger import CustomFormatter as cf
+from .logger import logger
+
+DONE = object()
+# workers forked from a process running threads could inherit a lock
+# (e.g. logging's) that one of them held
+FORKSERVER = multiprocessing.get_context("forkserver")
+
+
+class Stage:
+    """
+    A step of a Pipeline: func is called on every item for which when
+    returns True (others pass through untouched), by a number of
+    worker threads or, if processes, in a pool of worker processes.
+    func returns the item handed to the next stage, or with batch, is
+    called on lists of up to batch items and returns the ones that
+    succeeded
+    """
+
+    def __init__(self, name, func, workers=1, processes=False, when=None, batch=0):
+        self.name = name
+        self.func = func
+        self.workers = workers
+        self.processes = processes
+        self.when = when
+        self.batch = batch
+        self.done = 0
+
+
+class Pipeline:
+    """
+    Run items through stages concurrently, connected by bounded queues
+    so that a slow stage holds back the ones before it instead of
+    letting work pile up in memory. A single progress bar counts the
+    items that went through every stage
+    """
+
+    def __init__(self, stages, maxsize=PIPELINE_QUEUE_SIZE, desc="Processing"):
+        self._stages = stages
+        self._maxsize = maxsize
+        self._desc = desc
+        self._lock = threading.Lock()
+        self.results = []
+        self.failed = []
+
+    def run(self, items):
+        items = list(items)
+        queues = [queue.Queue(self._maxsize) for _ in self._stages]
+        pools = [
+            (
+                ProcessPoolExecutor(stage.workers, mp_context=FORKSERVER)
+                if stage.processes
+                else None
+            )
+            for stage in self._stages
+        ]
+        remaining = [stage.workers for stage in self._stages]
+
+        with logging_redirect_tqdm(), tqdm(total=len(items), desc=self._desc) as bar:
+
+            def fail(stage, item, error):
+                logger.error(
+                    f"{cf.RED}{stage.name} failed for "
+                    f"{getattr(item, 'id', item)}: {error}"
+                )
+                with self._lock:
+                    self.failed.append(item)
+                    bar.update()
+
+            def forward(index, item):
+                stage = self._stages[index]
+                with self._lock:
+                    stage.done += 1
+                if index + 1 < len(self._stages):
+                    queues[index + 1].put(item)
+                else:
+                    with self._lock:
+                        self.results.append(item)
+                        bar.update()
+                        bar.set_postfix(
+                            {stage.name: stage.done for stage in self._stages},
+                            refresh=False,
+                        )
+
+            def call(index, arg):
+                stage, pool = self._stages[index], pools[index]
+                if pool is None:
+                    return stage.func(arg)
+                return pool.submit(stage.func, arg).result()
+
+            def flush(index, batch):
+                stage = self._stages[index]
+                try:
+                    done = call(index, batch)
+                except Exception as e:
+                    for item in batch:
+                        fail(stage, item, e)
+                    return
+                succeeded = {id(item) for item in done}
+                for item in batch:
+                    if id(item) in succeeded:
+                        forward(index, item)
+                    else:
+                        fail(stage, item, "not in the batch's results")
+
+            def work(index):
+                stage = self._stages[index]
+                batch = []
+                while (item := queues[index].get()) is not DONE:
+                    try:
+                        if stage.when is not None and not stage.when(item):
+                            pass
+                        elif stage.batch:
+                            batch.append(item)
+                            if len(batch) == stage.batch:
+                                flush(index, batch)
+                                batch = []
+                            continue
+                        else:
+                            item = call(index, item)
+                    except Exception as e:
+                        fail(stage, item, e)
+                        continue
+                    forward(index, item)
+                if batch:
+                    flush(index, batch)
+
+                # the last worker out tells the next stage's workers to stop
+                with self._lock:
+                    remaining[index] -= 1
+                    last = not remaining[index]
+                if last and index + 1 < len(self._stages):
+                    for _ in range(self._stages[index + 1].workers):
+                        queues[index + 1].put(DONE)
+
+            threads = [
+                threading.Thread(target=work, args=(index,), daemon=True)
+                for index, stage in enumerate(self._stages)
+                for _ in range(stage.workers)
+            ]
+            for thread in threads:
+                thread.start()
+            for item in items:
+                queues[0].put(item)
+            for _ in range(self._stages[0].workers):
+                queues[0].put(DONE)
+            for thread in threads:
+                thread.join()
+
+        for pool in pools:
+            if pool is not None:
+                pool.shutdown()
+        if self.failed:
+            logger.warning(f"{cf.YELLOW}{len(self.failed)} items failed")
+        return self.results
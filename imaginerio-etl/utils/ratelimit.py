@@ -0,0 +1,136 @@
+import asyncio
+import threading
+import time
+
+from botocore.config import Config
+
+from ..config import *
+from .logger import CustomFormatter as cf
+
+THROTTLED = (429, 503)
+
+# botocore's adaptive mode keeps its own client-side token bucket
+# and slows down on S3 SlowDown/throttling errors
+BOTO_CONFIG = Config(retries={"max_attempts": 10, "mode": "adaptive"})
+
+
+class HostLimiter:
+    """
+    Token bucket and AIMD concurrency limit for a single host. Limits
+    grow additively while requests succeed and are halved whenever the
+    host throttles us, pausing it for as long as Retry-After asks
+    """
+
+    def __init__(self, rate, max_rate, concurrency, max_concurrency):
+        self.rate = rate
+        self.max_rate = max_rate
+        self.concurrency = concurrency
+        self.max_concurrency = max_concurrency
+        self.in_flight = 0
+        self.requests = 0
+        self.backoffs = 0
+        self._rate_step = rate / 10
+        self._tokens = rate
+        self._updated = time.monotonic()
+        self._paused_until = 0
+
+    def _refill(self, now):
+        self._tokens = min(self.rate, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            self._refill(now)
+            if now < self._paused_until:
+                await asyncio.sleep(self._paused_until - now)
+            elif self.in_flight >= int(self.concurrency):
+                await asyncio.sleep(0.01)
+            elif self._tokens < 1:
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+            else:
+                self._tokens -= 1
+                self.in_flight += 1
+                self.requests += 1
+                return
+
+    def release(self, status=None, retry_after=None):
+        self.in_flight -= 1
+        if status in THROTTLED:
+            self.throttled(retry_after)
+        elif status is not None and status < 500:
+            self.concurrency = min(
+                self.max_concurrency, self.concurrency + 1 / self.concurrency
+            )
+            self.rate = min(
+                self.max_rate, self.rate + self._rate_step / self.concurrency
+            )
+
+    def throttled(self, retry_after=None):
+        self.backoffs += 1
+        self.concurrency = max(1, self.concurrency / 2)
+        self.rate = max(self._rate_step, self.rate / 2)
+        self._tokens = min(self._tokens, 0)
+        if retry_after:
+            self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+
+    def metrics(self):
+        return {
+            "rate": round(self.rate, 2),
+            "concurrency": int(self.concurrency),
+            "requests": self.requests,
+            "backoffs": self.backoffs,
+        }
+
+
+class RateController:
+    """
+    Per-host limiters shared by the network client, starting from
+    RATE_LIMITS and adapting to what each service allows
+    """
+
+    def __init__(self, limits=RATE_LIMITS):
+        self._limits = limits
+        self._hosts = {}
+        self._lock = threading.Lock()
+
+    def limiter(self, host):
+        with self._lock:
+            if host not in self._hosts:
+                self._hosts[host] = HostLimiter(
+                    **self._limits.get(host, self._limits["default"])
+                )
+            return self._hosts[host]
+
+    def record_s3_retry(self, response=None, **kwargs):
+        """
+        botocore needs-retry hook counting S3 SlowDown responses, which
+        the clients' adaptive retry mode already backs off from
+        """
+        if response and response[0].status_code in THROTTLED:
+            self.limiter("s3").backoffs += 1
+
+    def metrics(self):
+        with self._lock:
+            return {host: limiter.metrics() for host, limiter in self._hosts.items()}
+
+    def summary(self):
+        throttled = {
+            host: metrics
+            for host, metrics in self.metrics().items()
+            if metrics["backoffs"]
+        }
+        if not throttled:
+            return ""
+        return (
+            "Throttled by "
+            + ", ".join(
+                f"{cf.YELLOW}{host}{cf.RESET} {metrics['backoffs']} times "
+                f"(settled at {metrics['rate']} req/s, {metrics['concurrency']} concurrent)"
+                for host, metrics in throttled.items()
+            )
+            + ". "
+        )
+
+
+controller = RateController()
@@ -0,0 +1,141 @@
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from ..config import *
+from .logger import logger
+
+
+def listdir(path):
+    """
+    Names of the files in a directory, as a set for membership tests
+    """
+    try:
+        with os.scandir(path) as entries:
+            return {entry.name for entry in entries if entry.is_file()}
+    except FileNotFoundError:
+        return set()
+
+
+def liststat(path):
+    """
+    (size, mtime) of the files in a directory, by name
+    """
+    files = {}
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.is_file():
+                    stat = entry.stat()
+                    files[entry.name] = (stat.st_size, stat.st_mtime_ns)
+    except FileNotFoundError:
+        pass
+    return files
+
+
+def restat(paths, workers=SCAN_WORKERS):
+    """
+    (path, size, mtime) of files as they are now, leaving out the ones
+    gone since they were listed
+    """
+
+    def stat(path):
+        try:
+            result = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return path, result.st_size, result.st_mtime_ns
+
+    with ThreadPoolExecutor(workers) as executor:
+        return [file for file in executor.map(stat, paths) if file]
+
+
+class Scanner:
+    """
+    Lists every file under a tree with os.scandir, walking top-level
+    directories in parallel. A manifest of each directory's listing is
+    cached by the directory's mtime, so directories where no file was
+    added, removed or renamed since the last run are not listed again.
+    Sizes and mtimes of their files come from the manifest, and are
+    stale for files rewritten in place since
+    """
+
+    def __init__(self, path=SOURCE_MANIFEST, workers=SCAN_WORKERS):
+        self._path = path
+        self._workers = workers
+        self._manifest = {}
+        self._listed = set()
+        try:
+            with open(path, encoding="utf8") as f:
+                self._cache = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            self._cache = {}
+
+    def scan_dir(self, path):
+        """
+        Files (name, size, mtime) and subdirectories of a directory
+        """
+        mtime = os.stat(path).st_mtime_ns
+        entry = self._cache.get(path)
+        if entry is None or entry["mtime"] != mtime:
+            files, dirs = [], []
+            with os.scandir(path) as entries:
+                for item in entries:
+                    if item.is_dir():
+                        dirs.append(item.name)
+                    elif item.is_file():
+                        stat = item.stat()
+                        files.append([item.name, stat.st_size, stat.st_mtime_ns])
+            entry = {"mtime": mtime, "files": files, "dirs": dirs}
+            self._listed.add(path)
+        self._manifest[path] = entry
+        return entry
+
+    def walk(self, root):
+        """
+        (path, size, mtime) of every file under root, depth first
+        """
+        files = []
+        stack = [root]
+        while stack:
+            path = stack.pop()
+            entry = self.scan_dir(path)
+            files.extend(
+                (os.path.join(path, name), size, mtime)
+                for name, size, mtime in entry["files"]
+            )
+            stack.extend(os.path.join(path, name) for name in entry["dirs"])
+        return files
+
+    def scan(self, root):
+        """
+        (path, size, mtime) of every file under root, one
+        thread per top-level directory
+        """
+        entry = self.scan_dir(root)
+        files = [
+            (os.path.join(root, name), size, mtime)
+            for name, size, mtime in entry["files"]
+        ]
+        with ThreadPoolExecutor(self._workers) as executor:
+            for subtree in executor.map(
+                self.walk, [os.path.join(root, name) for name in entry["dirs"]]
+            ):
+                files.extend(subtree)
+        logger.debug(
+            f"Found {len(files)} files in {len(self._manifest)} directories "
+            f"under {root}, {len(self._listed)} listed"
+        )
+        return files
+
+    def listed(self, path):
+        """
+        Whether a file's stat is fresh, its directory listed in this run
+        """
+        return os.path.dirname(path) in self._listed
+
+    def save(self):
+        os.makedirs(os.path.dirname(self._path) or ".", exist_ok=True)
+        with open(f"{self._path}.tmp", "w", encoding="utf8") as f:
+            json.dump(self._manifest, f)
+        os.replace(f"{self._path}.tmp", self._path)
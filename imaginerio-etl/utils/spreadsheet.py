@@ -0,0 +1,56 @@
+import os
+import re
+import zipfile
+
+import pandas as pd
+from openpyxl import Workbook
+
+from .logger import logger
+
+# rows converted and appended at a time
+CHUNKSIZE = 1000
+
+
+def read_excel(path):
+    """
+    Read the first sheet of a spreadsheet. pandas' openpyxl reader
+    streams the workbook in read-only mode, opened from a file object
+    so that xlsx files named .xls (as JSTOR exports them) are accepted.
+    The original headers are kept in attrs["headers"]
+    """
+    if zipfile.is_zipfile(path):
+        with open(path, "rb") as f:
+            df = pd.read_excel(f, engine="openpyxl")
+    else:
+        df = pd.read_excel(path)
+    df.attrs["headers"] = {strip_id(column): column for column in df.columns}
+    return df
+
+
+def strip_id(header):
+    """
+    Remove JSTOR's bracketed column id, e.g. Title[19462] -> Title
+    """
+    return re.sub(r"\[[0-9]*\]", "", header) if isinstance(header, str) else header
+
+
+def write_excel(df, path, index=True, headers=None, chunksize=CHUNKSIZE):
+    """
+    Write a DataFrame with openpyxl's write-only mode, appending rows
+    in chunks so that memory doesn't grow with the number of cells.
+    headers maps column names to the ones written, e.g. back to
+    JSTOR's bracketed ones
+    """
+    headers = headers or {}
+    if index:
+        df = df.reset_index()
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet()
+    sheet.append([headers.get(column, column) for column in df.columns])
+    for start in range(0, len(df), chunksize):
+        chunk = df.iloc[start : start + chunksize].astype(object)
+        for row in chunk.where(chunk.notna(), None).itertuples(index=False, name=None):
+            sheet.append(row)
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    workbook.save(path)
+    logger.debug(f"Wrote {len(df)} rows to {path}")
@@ -0,0 +1,12 @@
+import importlib
+import os
+
+import pytest
+
+# module-level boto3 clients need a region to be created
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+
+
+@pytest.fixture(scope="session")
+def ims():
+    return importlib.import_module("imaginerio-etl.scripts.ims")
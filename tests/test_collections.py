@@ -0,0 +1,29 @@
+import importlib
+
+import pandas as pd
+
+helpers = importlib.import_module("imaginerio-etl.utils.helpers")
+
+
+def test_collections_are_prefetched_and_parsed_on_use(tmp_path, monkeypatch):
+    cached = helpers.create_collection("views")
+    path = tmp_path / "views.json"
+    path.write_text(cached.json(), encoding="utf8")
+    fetched = []
+
+    async def fetch_collection(label):
+        fetched.append(label)
+        return str(path) if label == "views" else None
+
+    monkeypatch.setattr(helpers, "fetch_collection", fetch_collection)
+    metadata = pd.DataFrame({"Collection": ["views|all", "all", None]}, dtype=object)
+
+    collections = helpers.get_collections(metadata)
+
+    assert sorted(fetched) == ["all", "views"]
+    assert "views" in collections and "maps" not in collections
+    assert list(collections.keys()) == []
+    assert collections["views"].id == cached.id
+    # missing upstream, created from scratch
+    assert collections["all"].id.endswith("/collection/all.json")
+    assert sorted(collections.keys()) == ["all", "views"]
@@ -0,0 +1,66 @@
+import hashlib
+import importlib
+import json
+import os
+
+copier = importlib.import_module("imaginerio-etl.utils.copier")
+
+
+def test_stat_copies(tmp_path):
+    source = tmp_path / "source.tif"
+    source.write_bytes(b"a" * (copier.KERNEL_COPY_MIN + 1))
+    destination = str(tmp_path / "copy.tif")
+    # a sidecar left by a hashed copy no longer applies
+    with open(f"{destination}.sha256", "w") as f:
+        f.write("{}")
+
+    assert copier.copy_file(str(source), destination, verify="stat")
+    assert open(destination, "rb").read() == source.read_bytes()
+    assert not os.path.exists(f"{destination}.sha256")
+    assert not os.path.exists(f"{destination}.part")
+    assert copier.identical(str(source), destination, verify="stat")
+    assert not copier.copy_file(str(source), destination, verify="stat")
+
+    source.write_bytes(b"b")
+    assert not copier.identical(str(source), destination, verify="stat")
+    assert copier.copy_file(str(source), destination, verify="stat")
+    assert open(destination, "rb").read() == b"b"
+
+
+def test_hashed_copies(tmp_path):
+    source = tmp_path / "source.tif"
+    source.write_bytes(b"tiff")
+    destination = str(tmp_path / "copy.tif")
+
+    assert copier.copy_file(str(source), destination, verify="hash")
+    with open(f"{destination}.sha256") as f:
+        sidecar = json.load(f)
+    assert sidecar["sha256"] == hashlib.sha256(b"tiff").hexdigest()
+    assert not copier.copy_file(str(source), destination, verify="hash")
+
+    # touched but not changed: hashed again, not copied
+    os.utime(source, ns=(0, 10**9))
+    assert copier.identical(str(source), destination, verify="hash")
+    # the copy changed behind the sidecar's back
+    with open(destination, "ab") as f:
+        f.write(b"!")
+    assert not copier.identical(str(source), destination, verify="hash")
+    # contents already read are written as they are
+    assert copier.copy_file(str(source), destination, data=b"tiff", verify="hash")
+    assert open(destination, "rb").read() == b"tiff"
+    assert copier.identical(str(source), destination, verify="hash")
+
+
+def test_missing_files_are_not_identical(tmp_path):
+    source = tmp_path / "source.tif"
+    source.write_bytes(b"tiff")
+    for verify in ("stat", "hash"):
+        assert not copier.identical(str(source), str(tmp_path / "none"), verify)
+
+
+def test_hashing_copy(tmp_path):
+    source = tmp_path / "source.tif"
+    source.write_bytes(os.urandom(1000))
+    digest = copier.hashing_copy(str(source), str(tmp_path / "copy.tif"))
+    assert digest == hashlib.sha256(source.read_bytes()).hexdigest()
+    assert (tmp_path / "copy.tif").read_bytes() == source.read_bytes()
@@ -0,0 +1,85 @@
+import importlib
+import sys
+import threading
+
+import pytest
+
+exiftool = importlib.import_module("imaginerio-etl.entities.exiftool")
+
+# answers every command with its process id, exits on CRASH
+FAKE = """#!{python}
+import os
+import sys
+
+args = []
+for line in sys.stdin.buffer:
+    line = line.rstrip(b"\\n").decode()
+    if line.startswith("-execute"):
+        if "CRASH" in args:
+            os._exit(1)
+        sys.stdout.write("%d %s\\n{{ready%s}}\\n" % (
+            os.getpid(), " ".join(args), line[len("-execute"):]))
+        sys.stdout.flush()
+        args = []
+    elif args[-1:] == ["-stay_open"] and line == "False":
+        break
+    else:
+        args.append(line)
+"""
+
+
+@pytest.fixture
+def fake(tmp_path):
+    path = tmp_path / "exiftool"
+    path.write_text(FAKE.format(python=sys.executable))
+    path.chmod(0o755)
+    return str(path)
+
+
+def test_outputs_come_back_in_order(fake):
+    with exiftool.ExifTool(fake) as et:
+        futures = [et.submit(b"-a", str(i).encode()) for i in range(50)]
+        outputs = [
+            future.result().decode().split(" ", 1)[1].strip() for future in futures
+        ]
+    assert outputs == [f"-a {i}" for i in range(50)]
+
+
+def test_crashed_workers_are_restarted(fake):
+    with exiftool.ExifToolPool(2, fake) as pool:
+        with pytest.raises(IOError):
+            with pool.worker() as et:
+                crashed = et._process.pid
+                et.execute(b"CRASH")
+        assert pool.restarts == 1
+
+        pids = set()
+        barrier = threading.Barrier(2)
+
+        def use():
+            with pool.worker() as et:
+                barrier.wait(timeout=5)
+                pids.add(int(et.execute(b"x").split()[0]))
+
+        threads = [threading.Thread(target=use) for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert len(pids) == 2 and crashed not in pids
+
+        # one that exited while idle is replaced before it's lent
+        with pool.worker() as et:
+            et._process.kill()
+            et._process.wait()
+        with pool.worker(), pool.worker() as et:
+            assert et.alive
+            et.execute(b"x")
+        assert pool.restarts == 2
+
+
+def test_pool_must_be_running(fake):
+    pool = exiftool.ExifToolPool(1, fake)
+    with pytest.raises(ValueError):
+        with pool.worker():
+            pass
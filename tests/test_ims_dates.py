@@ -0,0 +1,143 @@
+import random
+
+import numpy as np
+import pandas as pd
+import pytest
+
+
+def reference_format_dates(df):
+    """
+    format_dates as it was before parsing was vectorized, one
+    pd.to_datetime call and DateOffset per value
+    """
+    accuracy_conditions = [
+        (df["Date"].str.count(r"[-\/^a-z]") == 0),
+        (df["Date"].str.count(r"[\/-]") == 1),
+        (df["Date"].str.count(r"[\/-]") == 2),
+        (df["Date"].str.contains(r"[a-z]", na=False)),
+    ]
+    accuracy_choices = ["year", "month", "day", "circa"]
+    df["date_accuracy"] = np.select(accuracy_conditions, accuracy_choices)
+
+    for column in ["First Year", "Last Year"]:
+        df[column] = df[column].str.extract(r"([\d\/-]*\d{4}[-\/\d]*)")
+    df["datetime"] = df["Date"].str.extract(r"([\d\/-]*\d{4}[-\/\d]*)")
+    for column in ["First Year", "Last Year", "datetime"]:
+        df[column] = df[column].map(
+            lambda x: pd.to_datetime(x, errors="coerce", yearfirst=True)
+        )
+
+    circa = df["date_accuracy"] == "circa"
+    year = df["date_accuracy"] == "year"
+    month = df["date_accuracy"] == "month"
+    day = df["date_accuracy"] == "day"
+
+    df.loc[circa & df["First Year"].isna(), "First Year"] = df[
+        "datetime"
+    ] - pd.DateOffset(years=5)
+    df.loc[circa & df["Last Year"].isna(), "Last Year"] = df[
+        "datetime"
+    ] + pd.DateOffset(years=5)
+    df.loc[df["First Year"].isna(), "First Year"] = df["datetime"]
+    df.loc[df["Last Year"].isna(), "Last Year"] = df["datetime"]
+
+    df["First Year"] = pd.to_datetime(df["First Year"]).dt.strftime("%Y")
+    df["Last Year"] = pd.to_datetime(df["Last Year"]).dt.strftime("%Y")
+
+    format_conditions = [circa, year, month, day]
+    format_choices = [
+        ("circa " + (df["datetime"].dt.strftime("%Y"))),
+        df["datetime"].dt.strftime("%Y"),
+        df["datetime"].dt.strftime("%m/%Y"),
+        df["datetime"].dt.strftime("%d/%m/%Y"),
+    ]
+    df["Date"] = np.select(format_conditions, format_choices)
+
+
+def synthetic_dates(n, seed=0):
+    """
+    Dates in the shapes found in the Cumulus export, including
+    invalid days and months. Years stay clear of the lower bound
+    of datetime64[ns], where the reference overflows
+    """
+    rng = random.Random(seed)
+    shapes = [
+        "{y}",
+        "{m}/{y}",
+        "{m}-{y}",
+        "{y}/{m}",
+        "{y}-{m}",
+        "{d}/{m}/{y}",
+        "{m}/{d}/{y}",
+        "{d}-{m}-{y}",
+        "{y}-{m}-{d}",
+        "{y}/{m}/{d}",
+        "circa {y}",
+        "c. {y}",
+        "ca. {m}/{y}",
+        "década de {y}",
+        "{d}/{m}/{y} - {d}/{m}/{y}",
+    ]
+    rows = []
+    for _ in range(n):
+        parts = {
+            "y": rng.randint(1690, 2100),
+            "m": str(rng.randint(0, 14)).zfill(rng.choice([1, 2])),
+            "d": str(rng.randint(0, 32)).zfill(rng.choice([1, 2])),
+        }
+        bound = lambda: rng.choice(
+            [np.nan, "", str(parts["y"] + rng.randint(-10, 10)), "s/d"]
+        )
+        date = rng.choice(shapes).format(**parts) if rng.random() > 0.01 else None
+        rows.append(
+            {
+                "Date": date,
+                "First Year": bound(),
+                "Last Year": bound(),
+            }
+        )
+    return pd.DataFrame(rows)
+
+
+def test_format_dates_matches_reference(ims):
+    df = synthetic_dates(6000)
+    expected = df.copy()
+    reference_format_dates(expected)
+    ims.format_dates(df)
+    # dates matching no accuracy, like ranges or missing ones, were set
+    # to the integer 0, which the string Date column can't hold
+    unmatched = expected["date_accuracy"] == "0"
+    assert unmatched.any() and (expected.loc[unmatched, "Date"] == 0).all()
+    expected.loc[unmatched, "Date"] = np.nan
+
+    columns = ["Date", "First Year", "Last Year", "date_accuracy"]
+    pd.testing.assert_frame_equal(
+        df[columns].astype(object).where(df[columns].notna(), None),
+        expected[columns].astype(object).where(expected[columns].notna(), None),
+    )
+
+
+@pytest.mark.parametrize(
+    "value",
+    ["1920", "10/1920", "1920/10", "31/12/1920", "12/31/1920", "1920-02-30", "1999"],
+)
+def test_parse_dates_matches_pandas(ims, value):
+    parsed = ims.parse_dates(pd.Series([value, np.nan]))
+    expected = pd.to_datetime(value, errors="coerce", yearfirst=True)
+    assert parsed[0] == expected or (pd.isna(parsed[0]) and pd.isna(expected))
+    assert pd.isna(parsed[1])
+
+
+def test_circa_before_datetime_range(ims):
+    # the reference raised OverflowError subtracting five years
+    # from circa dates near 1677, years are now plain integers
+    df = pd.DataFrame(
+        {"Date": ["circa 1680"], "First Year": [None], "Last Year": [None]},
+        dtype=object,
+    )
+    ims.format_dates(df)
+    assert df.loc[0, ["Date", "First Year", "Last Year"]].to_list() == [
+        "circa 1680",
+        "1675",
+        "1685",
+    ]
@@ -0,0 +1,107 @@
+import numpy as np
+import pandas as pd
+
+
+def formatted_chunk(ims, dates):
+    df = pd.DataFrame(
+        {
+            "Document ID": [f"0071{i:04d}" for i in range(len(dates))],
+            "Date": dates,
+            "First Year": [None] * len(dates),
+            "Last Year": [None] * len(dates),
+        },
+        dtype=object,
+    )
+    ims.format_dates(df)
+    return df.reindex(columns=ims.IMS_COLUMNS).set_index("Document ID")
+
+
+def test_write_chunks_with_date_range(ims, tmp_path):
+    # three or more separators and no letters match no accuracy
+    chunk = formatted_chunk(ims, ["10/10/1920 - 15/10/1920", "1920"])
+    path = str(tmp_path / "formatted.parquet")
+
+    assert ims.write_chunks([chunk], path, ims.IMS_SCHEMA) == 2
+
+    written = pd.read_parquet(path).set_index("Document ID")
+    assert pd.isna(written.loc["00710000", "Date"])
+    assert written.loc["00710001", "Date"] == "1920"
+
+    # the CSV export is written by the merge
+    metadata = str(tmp_path / "faltantes.csv")
+    ims.MetadataMerge(metadata, source=path).commit()
+    csv = pd.read_csv(metadata, index_col="Document ID", dtype=str)
+    assert csv["Date"].to_list()[1] == "1920"
+    assert pd.isna(csv["Date"].to_list()[0])
+
+
+def fake_format(ims, monkeypatch):
+    def format_data(df):
+        out = df.rename(columns={"Record Name": "Document ID"})
+        out["Title"] = out["Title"].str.upper()
+        return out.reindex(columns=ims.IMS_COLUMNS).set_index("Document ID")
+
+    monkeypatch.setattr(ims, "format_data", format_data)
+
+
+def test_fingerprints_reuse_formatted_rows(ims, tmp_path, monkeypatch):
+    fake_format(ims, monkeypatch)
+    raw = pd.DataFrame({"Record Name": ["00710001"], "Title": ["praça xv"]})
+    output = str(tmp_path / "formatted.parquet")
+    delta_path = str(tmp_path / "delta.json")
+    metadata = str(tmp_path / "faltantes.csv")
+
+    store = ims.FingerprintStore(output)
+    ims.write_chunks([store.format(raw)], output)
+    assert store.save(delta_path)["new"] == ["00710001"]
+
+    # later stages merge their values into the dataset, not the output
+    merge = ims.MetadataMerge(metadata, source=output)
+    merge.submit(pd.DataFrame({"Title": ["Merged"]}, index=["00710001"]))
+    assert merge.commit().loc["00710001", "Title"] == "Merged"
+
+    monkeypatch.setattr(ims, "format_data", None)
+    store = ims.FingerprintStore(output)
+    reused = store.format(raw)
+    assert store.delta() == {"new": [], "changed": [], "removed": []}
+    assert reused.loc["00710001", "Title"] == "PRAÇA XV"
+
+
+def test_fingerprints_read_reused_rows_across_row_groups(ims, tmp_path, monkeypatch):
+    fake_format(ims, monkeypatch)
+    names = [f"0071{i:04d}" for i in range(6)]
+    raw = pd.DataFrame({"Record Name": names, "Title": [f"t{i}" for i in range(6)]})
+    output = str(tmp_path / "formatted.parquet")
+    store = ims.FingerprintStore(output)
+    ims.write_chunks(map(store.format, [raw[:2], raw[2:4], raw[4:]]), output)
+
+    # reordered, one changed and one removed
+    raw = raw.iloc[[5, 0, 3, 2, 1]].reset_index(drop=True)
+    raw.loc[2, "Title"] = "changed"
+    store = ims.FingerprintStore(output)
+    formatted = store.format(raw)
+    ims.write_chunks([formatted], output)
+
+    assert formatted.index.to_list() == [names[i] for i in (5, 0, 3, 2, 1)]
+    assert formatted["Title"].to_list() == ["T5", "T0", "CHANGED", "T2", "T1"]
+    assert store.delta() == {
+        "new": [],
+        "changed": ["00710003"],
+        "removed": ["00710004"],
+    }
+
+
+def test_xml_chunks_drop_repeated_records(ims, monkeypatch):
+    fields = ["Record Name", "DATA", "DATA LIMITE INFERIOR", "DATA LIMITE SUPERIOR"]
+    rows = [["a", "1920", None, None], ["b", "1921", None, None]]
+    records = [rows[0], rows[1], rows[0], rows[1], rows[0]]
+    columns = [[row[i] for row in records] for i in range(len(fields))]
+    chunk = ims.build_chunk(fields, columns)
+
+    seen = np.empty(0, dtype="uint64")
+    first, seen = ims.drop_seen(chunk[:1], seen)
+    rest, seen = ims.drop_seen(chunk[1:], seen)
+
+    assert first["Record Name"].to_list() == ["a"]
+    assert rest["Record Name"].to_list() == ["b"]
+    assert len(seen) == 2
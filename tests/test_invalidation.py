@@ -0,0 +1,54 @@
+import importlib
+
+import pytest
+
+invalidation = importlib.import_module("imaginerio-etl.utils.invalidation")
+
+
+@pytest.fixture
+def manager():
+    client = invalidation.LocalInvalidationClient()
+    return invalidation.InvalidationManager("E123", client=client)
+
+
+def test_directories_collapse_into_wildcards(manager):
+    manager.update(["iiif/0071/info.json", "/iiif/0071/manifest.json"])
+    manager.add("iiif/0072/manifest.json")
+    manager.add("index.json")
+
+    paths = ["/iiif/0071/*", "/iiif/0072/manifest.json", "/index.json"]
+    assert manager.flush() == paths
+    assert manager.client.batches == [paths]
+
+
+def test_many_manifests_climb_to_a_shallower_wildcard(manager):
+    # one manifest per directory never collapses at the default depth
+    manager.update(f"iiif/{i:05d}/manifest.json" for i in range(7001))
+    manager.add("iiif/collection/all.json")
+    manager.add("index.json")
+
+    assert manager.flush() == ["/iiif/*", "/index.json"]
+    assert len(manager.client.batches) == 1
+
+
+def test_too_many_wildcards_climb_to_a_shallower_wildcard(manager):
+    for i in range(invalidation.MAX_WILDCARDS + 1):
+        manager.update([f"iiif/{i}/info.json", f"iiif/{i}/manifest.json"])
+    manager.add("iiif/collection/all.json")
+
+    assert manager.flush() == ["/iiif/*"]
+
+
+def test_spread_keys_invalidate_everything(manager):
+    manager.update(f"{i:05d}.json" for i in range(invalidation.MAX_PATHS + 1))
+
+    assert manager.flush() == ["/*"]
+    assert manager.client.batches == [["/*"]]
+
+
+def test_flush_forgets_keys(manager):
+    manager.add("iiif/0071/manifest.json")
+    manager.flush()
+
+    assert manager.flush() == []
+    assert len(manager.client.batches) == 1
@@ -0,0 +1,83 @@
+import importlib
+import os
+import time
+
+inventory = importlib.import_module("imaginerio-etl.utils.inventory")
+
+
+class FakeS3:
+    """
+    list_objects_v2 paginator over a fixed set of pages, counting listings
+    """
+
+    def __init__(self, pages):
+        self.pages = pages
+        self.listings = 0
+
+    def get_paginator(self, operation):
+        return self
+
+    def paginate(self, Bucket, Prefix):
+        self.listings += 1
+        return [
+            {"Contents": [{"Key": k, "Size": s, "ETag": e} for k, s, e in page]}
+            for page in self.pages
+        ]
+
+
+def make(tmp_path, client, max_age=24):
+    return inventory.Inventory(
+        path=str(tmp_path / "inventory.parquet"), max_age=max_age, client=client
+    )
+
+
+def test_bucket_is_listed_once_and_cached(tmp_path):
+    client = FakeS3(
+        [[("iiif/0071/info.json", 10, '"a"')], [("iiif/0072/info.json", 20, '"b"')]]
+    )
+    first = make(tmp_path, client)
+    assert "iiif/0071/info.json" in first
+    assert first.size("iiif/0072/info.json") == 20
+    assert first.etag("iiif/0072/info.json") == '"b"'
+    assert not first.exists("iiif/0073/info.json")
+
+    second = make(tmp_path, client)
+    assert second.size("iiif/0071/info.json") == 10
+    assert client.listings == 1
+
+    stale = make(tmp_path, client, max_age=0)
+    assert stale.exists("iiif/0071/info.json")
+    assert client.listings == 2
+
+
+def test_uploads_before_a_load_are_merged(tmp_path):
+    client = FakeS3([[("iiif/0071/info.json", 10, '"a"')]])
+    make(tmp_path, client).objects
+    path = str(tmp_path / "inventory.parquet")
+    listed = time.time() - 3600
+    os.utime(path, (listed, listed))
+
+    # a run that never queried the inventory still saves its uploads
+    uploads = make(tmp_path, client)
+    uploads.add("iiif/0072/manifest.json", 30, '"c"')
+    uploads.save()
+    assert os.path.getmtime(path) == listed
+
+    merged = make(tmp_path, client)
+    assert merged.size("iiif/0072/manifest.json") == 30
+    assert merged.exists("iiif/0071/info.json")
+    assert client.listings == 1
+
+
+def test_uploads_are_handed_over_between_processes(tmp_path):
+    client = FakeS3([[]])
+    worker = make(tmp_path, client)
+    worker.add("iiif/0071/manifest.json", 30)
+    worker.add("iiif/0072/manifest.json", 40)
+    added = worker.drain()
+    assert worker.drain() == {}
+
+    parent = make(tmp_path, client)
+    parent.update(added)
+    assert parent.size("iiif/0072/manifest.json") == 40
+    assert parent.etag("iiif/0072/manifest.json") is None
@@ -0,0 +1,69 @@
+import importlib
+from datetime import datetime, timedelta
+
+import pandas as pd
+
+journal = importlib.import_module("imaginerio-etl.utils.journal")
+
+
+def test_entries_survive_a_restart_for_the_same_row(tmp_path):
+    path = str(tmp_path / "journal.jsonl")
+    row = pd.Series({"Title": "Praça XV"})
+    stamp = journal.fingerprint(row)
+
+    log = journal.Journal(path)
+    log.record("0071", "uploaded", stamp, size=[100, 80])
+    log.close()
+    # a run killed mid-write leaves half a line
+    with open(path, "a", encoding="utf8") as f:
+        f.write('{"id": "0072", "sta')
+
+    log = journal.Journal(path)
+    assert log.done("0071", "uploaded", stamp)
+    assert log.get("0071", "uploaded", stamp)["size"] == [100, 80]
+    assert not log.done("0072", "uploaded", stamp)
+    # the row changed since
+    changed = journal.fingerprint(pd.Series({"Title": "Praça 15"}))
+    assert not log.done("0071", "uploaded", changed)
+    assert log.get("0071", "uploaded", changed) is None
+    log.close()
+
+
+def test_clear_empties_the_journal(tmp_path):
+    path = str(tmp_path / "journal.jsonl")
+    log = journal.Journal(path)
+    log.record("0071", "published", "stamp")
+    log.clear()
+    log.record("0072", "published", "stamp")
+    log.close()
+
+    log = journal.Journal(path)
+    assert not log.done("0071", "published", "stamp")
+    assert log.done("0072", "published", "stamp")
+    log.close()
+
+
+def test_retries_back_off_exponentially(tmp_path, monkeypatch):
+    monkeypatch.setattr(journal, "RETRY_BACKOFF", 6)
+    monkeypatch.setattr(journal, "RETRY_MAX_BACKOFF", 20)
+    path = str(tmp_path / "retry.json")
+    queue = journal.RetryQueue(path)
+    now = datetime.now()
+
+    queue.fail("0071")
+    assert "0071" in queue
+    assert queue.due(now) == []
+    assert queue.due(now + timedelta(hours=6, minutes=1)) == ["0071"]
+
+    queue.fail("0071")
+    assert queue.due(now + timedelta(hours=11)) == []
+    assert queue.due(now + timedelta(hours=12, minutes=1)) == ["0071"]
+    # capped at RETRY_MAX_BACKOFF
+    queue.fail("0071")
+    assert queue.due(now + timedelta(hours=20, minutes=1)) == ["0071"]
+
+    queue.save()
+    queue = journal.RetryQueue(path)
+    assert "0071" in queue
+    queue.succeed("0071")
+    assert "0071" not in queue
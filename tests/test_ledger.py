@@ -0,0 +1,120 @@
+import importlib
+import os
+from types import SimpleNamespace
+
+import pytest
+
+ledger = importlib.import_module("imaginerio-etl.utils.ledger")
+copier = importlib.import_module("imaginerio-etl.utils.copier")
+
+
+def image(id, in_catalog=True, done=(), embedded=False, metadata=(b"-x",)):
+    return SimpleNamespace(
+        id=id,
+        tif=f"{id}.tif",
+        to_tif=True,
+        to_jpg=True,
+        in_catalog=in_catalog,
+        done=set(done),
+        embedded=embedded,
+        metadata=list(metadata),
+    )
+
+
+@pytest.fixture
+def sources(tmp_path, monkeypatch):
+    monkeypatch.setenv("TIF", str(tmp_path / "tif"))
+    os.mkdir(tmp_path / "tif")
+    os.mkdir(tmp_path / "src")
+    for id in ("a", "b", "c"):
+        (tmp_path / "src" / f"{id}.tif").write_bytes(id.encode())
+    return tmp_path
+
+
+def scan(root):
+    files = []
+    for name in sorted(os.listdir(root / "src")):
+        path = str(root / "src" / name)
+        stat = os.stat(path)
+        files.append((path, stat.st_size, stat.st_mtime_ns))
+    return files
+
+
+def test_stages_are_recorded(sources):
+    db = ledger.Ledger(str(sources / "ledger.db"))
+    files = scan(sources)
+    versions = {"a": "v1", "b": "v1"}
+    assert db.pending(files, versions) == {"a", "b", "c"}
+    # nothing known yet, to be checked on disk
+    assert db.states(files, versions) == {}
+
+    db.record(
+        [
+            image("a", done={"copied", "converted"}, embedded=True),
+            # converted, but exiftool failed
+            image("b", done={"copied", "converted"}),
+            image("c", in_catalog=False, done={"copied"}),
+        ]
+    )
+    assert db.pending(files, versions) == {"b"}
+
+    states = db.states(files, versions)
+    assert {os.path.basename(path): state for path, state in states.items()} == {
+        "a.tif": {"to_tif": False, "to_jpg": False, "to_embed": False},
+        "b.tif": {"to_tif": False, "to_jpg": False, "to_embed": True},
+        # nothing to embed out of the catalog
+        "c.tif": {"to_tif": False, "to_jpg": True, "to_embed": False},
+    }
+
+    # a's metadata changed, c entered the catalog
+    versions = {"a": "v2", "b": "v1", "c": "v1"}
+    assert db.pending(files, versions) == {"b", "c"}
+    states = db.states(files, versions)
+    assert states[files[0][0]]["to_embed"]
+    assert states[files[2][0]]["to_jpg"] and states[files[2][0]]["to_embed"]
+    db.close()
+
+
+def test_stages_left_after_a_failure(sources):
+    db = ledger.Ledger(str(sources / "ledger.db"))
+    files = scan(sources)
+    versions = {"a": "v1", "b": "v1"}
+    db.states(files, versions)
+    # copied, conversion failed; never copied
+    db.record([image("a", done={"copied"}), image("b")])
+    assert db.pending(files, versions) == {"a", "b", "c"}
+    states = db.states(files, versions)
+    assert states[files[0][0]] == {"to_tif": False, "to_jpg": True, "to_embed": True}
+    assert states[files[1][0]]["to_tif"]
+
+
+def test_touched_sources_are_hashed(sources):
+    db = ledger.Ledger(str(sources / "ledger.db"))
+    files = scan(sources)
+    versions = {"a": "v1"}
+    source = files[0][0]
+    tif = str(sources / "tif" / "a.tif")
+    copier.copy_file(source, tif, verify="hash")
+    db.states(files, versions)
+    db.record([image("a", done={"copied", "converted"}, embedded=True)])
+
+    # touched, not modified, and the sidecar gone since
+    os.remove(f"{tif}.sha256")
+    os.utime(source, ns=(0, 10**9))
+    files = scan(sources)
+    assert "a" in db.pending(files, versions)
+    state = db.states(files, versions)[source]
+    assert state == {"to_tif": False, "to_jpg": False, "to_embed": False}
+    # the digest is carried over to the new stat
+    image_a = image("a", embedded=True)
+    image_a.to_tif = image_a.to_jpg = False
+    db.record([image_a])
+    row = db._db.execute("SELECT mtime, sha256 FROM images WHERE id = 'a'").fetchone()
+    assert row == (10**9, copier.sha256(source))
+    assert "a" not in db.pending(files, versions)
+
+    # modified
+    with open(source, "ab") as f:
+        f.write(b"!")
+    files = scan(sources)
+    assert db.states(files, versions)[source]["to_tif"]
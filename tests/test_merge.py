@@ -0,0 +1,94 @@
+import importlib
+import os
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+merge = importlib.import_module("imaginerio-etl.utils.merge")
+
+SCHEMA = pa.schema(
+    [
+        ("Document ID", pa.string()),
+        ("Title", pa.string()),
+        ("Document URL", pa.string()),
+        ("Width", pa.float64()),
+    ]
+)
+
+
+def write_source(path, *groups):
+    """
+    Parquet file with a row group per frame of groups
+    """
+    with pq.ParquetWriter(path, SCHEMA) as writer:
+        for group in groups:
+            writer.write_table(
+                pa.Table.from_pandas(
+                    pd.DataFrame(group).reindex(columns=SCHEMA.names),
+                    schema=SCHEMA,
+                    preserve_index=False,
+                )
+            )
+
+
+def test_submitted_values_are_merged_in_one_pass(tmp_path):
+    source = str(tmp_path / "formatted.parquet")
+    write_source(
+        source,
+        {"Document ID": ["a", "b"], "Title": ["A", "B"], "Width": [1.0, None]},
+        {"Document ID": ["c"], "Title": ["C"], "Width": [3.0]},
+    )
+    path = str(tmp_path / "faltantes.csv")
+    metadata = merge.MetadataMerge(path, source=source)
+    assert metadata.ids().to_list() == ["a", "b", "c"]
+
+    metadata.submit(
+        pd.DataFrame(
+            {"Document URL": ["url-c", "url-z"], "Title": [None, "Z"]},
+            index=["c", "z"],
+        )
+    )
+    metadata.submit(pd.DataFrame({"Title": ["B2", "B3"]}, index=["b", "b"]))
+    assert metadata.records({"b"})["Title"].to_list() == ["B2"]
+
+    subset = metadata.commit({"b", "c"})
+    assert subset.index.to_list() == ["b", "c"]
+    assert subset.loc["c", "Title"] == "C"
+    assert subset.loc["c", "Document URL"] == "url-c"
+
+    written = pd.read_parquet(os.path.splitext(path)[0] + ".parquet")
+    assert written.columns.to_list() == SCHEMA.names
+    assert written["Title"].to_list() == ["A", "B2", "C"]
+    assert written["Document URL"].to_list() == [None, None, "url-c"]
+    csv = pd.read_csv(path, index_col="Document ID", dtype=str)
+    assert csv.index.to_list() == ["a", "b", "c"]
+    assert csv.loc["c", "Document URL"] == "url-c"
+
+    # the outputs are read from now on
+    reread = merge.MetadataMerge(path)
+    assert reread.metadata.loc["b", "Title"] == "B2"
+    assert reread.metadata["Width"].dtype == float
+
+
+def test_nothing_is_written_without_updates(tmp_path):
+    path = str(tmp_path / "faltantes.csv")
+    write_source(
+        os.path.splitext(path)[0] + ".parquet",
+        {"Document ID": ["a"], "Title": ["A"]},
+    )
+    assert merge.MetadataMerge(path).commit().index.to_list() == ["a"]
+    assert not os.path.exists(path)
+
+
+def test_csv_is_read_without_parquet(tmp_path):
+    path = str(tmp_path / "faltantes.csv")
+    pd.DataFrame({"Document ID": ["a"], "Title": ["A"], "Width": ["1.5"]}).to_csv(
+        path, index=False
+    )
+    metadata = merge.MetadataMerge(path)
+    metadata.submit(pd.DataFrame({"Title": ["A2"]}, index=["a"]))
+
+    committed = metadata.commit()
+    assert committed.loc["a", "Width"] == 1.5
+    assert pd.read_parquet(str(tmp_path / "faltantes.parquet"))["Title"][0] == "A2"
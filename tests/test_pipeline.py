@@ -0,0 +1,83 @@
+import importlib
+import threading
+
+pipeline = importlib.import_module("imaginerio-etl.utils.pipeline")
+
+
+class Item:
+    def __init__(self, id):
+        self.id = id
+        self.stages = []
+
+
+def stage(name, log, fail=(), **kwargs):
+    lock = threading.Lock()
+
+    def func(item):
+        if item.id in fail:
+            raise RuntimeError(f"{name} broke")
+        with lock:
+            item.stages.append(name)
+            log.append((name, item.id))
+        return item
+
+    return pipeline.Stage(name, func, **kwargs)
+
+
+def test_items_go_through_stages_in_order():
+    log = []
+    items = [Item(i) for i in range(20)]
+    runner = pipeline.Pipeline(
+        [
+            stage("copy", log, workers=3),
+            stage("convert", log, workers=2, when=lambda item: item.id % 2),
+            stage("embed", log),
+        ],
+        maxsize=2,
+    )
+    results = runner.run(items)
+
+    assert sorted(item.id for item in results) == list(range(20))
+    assert not runner.failed
+    for item in items:
+        expected = ["copy", "convert", "embed"] if item.id % 2 else ["copy", "embed"]
+        assert item.stages == expected
+    assert [s.done for s in runner._stages] == [20, 20, 20]
+    # embedding runs in a single worker, in the order items arrived
+    embedded = [id for name, id in log if name == "embed"]
+    assert embedded == [item.id for item in results]
+
+
+def test_failed_items_leave_the_others_running():
+    log = []
+    items = [Item(i) for i in range(10)]
+    runner = pipeline.Pipeline(
+        [stage("copy", log, workers=2), stage("convert", log, fail={3, 7})]
+    )
+    results = runner.run(items)
+
+    assert sorted(item.id for item in results) == [0, 1, 2, 4, 5, 6, 8, 9]
+    assert sorted(item.id for item in runner.failed) == [3, 7]
+    # stages before the failure stay done
+    assert items[3].stages == ["copy"]
+
+
+def test_batch_stages():
+    batches = []
+
+    def embed(batch):
+        batches.append(len(batch))
+        if any(item.id == 4 for item in batch):
+            raise RuntimeError("exiftool died")
+        # the ones not returned failed
+        return [item for item in batch if item.id != 1]
+
+    items = [Item(i) for i in range(7)]
+    runner = pipeline.Pipeline(
+        [stage("copy", []), pipeline.Stage("embed", embed, batch=3)]
+    )
+    results = runner.run(items)
+
+    assert batches == [3, 3, 1]
+    assert [item.id for item in results] == [0, 2, 6]
+    assert sorted(item.id for item in runner.failed) == [1, 3, 4, 5]
@@ -0,0 +1,99 @@
+import importlib
+
+import numpy as np
+import pandas as pd
+import pytest
+
+portals = importlib.import_module("imaginerio-etl.scripts.portals")
+
+PREFIX = "https://portals.example.org/asset/"
+
+
+@pytest.fixture(autouse=True)
+def prefix(monkeypatch):
+    monkeypatch.setenv("PORTALS_PREFIX", PREFIX)
+
+
+def urls(**ids):
+    return pd.DataFrame(
+        {"Document URL": [f"{PREFIX}{record}" for record in ids.values()]},
+        index=pd.Index(list(ids), name="Document ID"),
+    )
+
+
+def test_pages_become_a_frame_first_match_first():
+    pages = [
+        (np.array([10, 11], dtype=object), np.array(["0071.jpg", "0072.jpg"])),
+        (np.array([12], dtype=object), np.array(["0071.tif"])),
+    ]
+    frame = portals.to_frame(pages)
+    assert frame.to_dict()["Document URL"] == {
+        "0071": f"{PREFIX}10",
+        "0072": f"{PREFIX}11",
+    }
+    assert portals.to_frame([]).empty
+
+
+def test_merge_drops_unpublished_items_past_the_sync_start(tmp_path):
+    mapped = portals.PortalsMap(str(tmp_path / "portals.csv"))
+    mapped.merge(urls(a=1, b=5, c=7))
+    mapped.mapped.clear()
+
+    # every item from record 5 on: c was unpublished, b moved
+    mapped.merge(urls(b=6, d=8), since=5)
+
+    assert mapped.urls.to_dict()["Document URL"] == {
+        "a": f"{PREFIX}1",
+        "b": f"{PREFIX}6",
+        "d": f"{PREFIX}8",
+    }
+    assert mapped.mapped == {"b", "d"}
+
+
+def test_map_and_cursor_persist(tmp_path):
+    path = str(tmp_path / "portals.csv")
+    mapped = portals.PortalsMap(path)
+    mapped.merge(urls(a=1))
+    mapped.cursor = 120
+    mapped.save()
+
+    loaded = portals.PortalsMap(path)
+    assert loaded.cursor == 120
+    assert "a" in loaded and "b" not in loaded
+    assert portals.record_ids(loaded.urls).to_list() == [1]
+
+    loaded.clear()
+    assert loaded.cursor == 0 and "a" not in loaded
+
+
+def test_main_syncs_from_the_cursor_and_searches_a_few_unmapped(tmp_path, monkeypatch):
+    path = str(tmp_path / "portals.csv")
+    saved = portals.PortalsMap(path)
+    saved.merge(urls(a=1, b=2))
+    saved.cursor = 2
+    saved.save()
+    fetched, searched = [], []
+
+    def fetch(start_index, total_count):
+        fetched.append(start_index)
+        return urls(c=3)
+
+    def resolve(ids):
+        searched.extend(ids)
+        return urls(x=9)
+
+    PortalsMap = portals.PortalsMap
+    monkeypatch.setattr(portals, "PortalsMap", lambda: PortalsMap(path))
+    monkeypatch.setattr(portals, "get_total_count", lambda: 3)
+    monkeypatch.setattr(portals, "fetch", fetch)
+    monkeypatch.setattr(portals, "resolve", resolve)
+    monkeypatch.setattr(portals, "PORTALS_OVERLAP", 1)
+    monkeypatch.setattr(portals, "PORTALS_MAX_SEARCHES", 1)
+
+    result = portals.main(["x", "y", "a"], resync="false")
+
+    assert fetched == [1]
+    assert searched == ["x"]
+    assert sorted(result.index) == ["a", "b", "c", "x"]
+    assert result.attrs["mapped"] == ["c", "x"]
+    assert PortalsMap(path).cursor == 3
@@ -0,0 +1,94 @@
+import asyncio
+import importlib
+import time
+
+ratelimit = importlib.import_module("imaginerio-etl.utils.ratelimit")
+
+
+def limiter(**kwargs):
+    limits = {"rate": 100, "max_rate": 200, "concurrency": 2, "max_concurrency": 4}
+    return ratelimit.HostLimiter(**{**limits, **kwargs})
+
+
+def test_limits_grow_while_requests_succeed():
+    host = limiter()
+
+    async def requests(n):
+        for _ in range(n):
+            await host.acquire()
+            host.release(200)
+
+    asyncio.run(requests(100))
+    assert host.concurrency == 4
+    assert host.rate == 200
+    assert host.requests == 100
+    assert host.in_flight == 0
+
+
+def test_throttling_halves_limits_and_honours_retry_after():
+    host = limiter(rate=1000, max_rate=1000, concurrency=4)
+
+    async def throttled():
+        await host.acquire()
+        host.release(429, retry_after=0.2)
+        start = time.monotonic()
+        await host.acquire()
+        return time.monotonic() - start
+
+    assert asyncio.run(throttled()) >= 0.2
+    assert host.concurrency == 2
+    assert host.rate == 500
+    assert host.backoffs == 1
+    # server errors other than 503 leave the limits alone
+    host.release(500)
+    assert host.metrics() == {
+        "rate": 500,
+        "concurrency": 2,
+        "requests": 2,
+        "backoffs": 1,
+    }
+
+
+def test_concurrency_caps_requests_in_flight():
+    host = limiter(rate=1000, max_rate=1000, concurrency=2, max_concurrency=2)
+    peak = 0
+
+    async def request():
+        nonlocal peak
+        await host.acquire()
+        peak = max(peak, host.in_flight)
+        await asyncio.sleep(0.02)
+        host.release(200)
+
+    async def requests():
+        await asyncio.gather(*(request() for _ in range(6)))
+
+    asyncio.run(requests())
+    assert peak == 2
+
+
+def test_controller_keeps_a_limiter_per_host():
+    controller = ratelimit.RateController(
+        {
+            "default": {
+                "rate": 5,
+                "max_rate": 5,
+                "concurrency": 1,
+                "max_concurrency": 1,
+            },
+            "api.example.org": {
+                "rate": 50,
+                "max_rate": 50,
+                "concurrency": 8,
+                "max_concurrency": 8,
+            },
+        }
+    )
+    assert controller.limiter("api.example.org").rate == 50
+    assert controller.limiter("other.org").rate == 5
+    assert controller.limiter("other.org") is controller.limiter("other.org")
+    assert controller.summary() == ""
+
+    controller.limiter("other.org").throttled()
+    assert "other.org" in controller.summary()
+    assert "api.example.org" not in controller.summary()
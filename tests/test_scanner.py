@@ -0,0 +1,65 @@
+import importlib
+import os
+
+scanner = importlib.import_module("imaginerio-etl.utils.scanner")
+
+
+def write(path, content=b"x"):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(content)
+
+
+def test_unchanged_directories_come_from_the_manifest(tmp_path):
+    root = str(tmp_path / "src")
+    for name in ("a/1.tif", "a/deep/2.tif", "b/3.tif", "4.tif"):
+        write(os.path.join(root, name))
+    manifest = str(tmp_path / "manifest.json")
+
+    first = scanner.Scanner(manifest, workers=2)
+    files = first.scan(root)
+    assert sorted(os.path.relpath(path, root) for path, _, _ in files) == [
+        "4.tif",
+        "a/1.tif",
+        "a/deep/2.tif",
+        "b/3.tif",
+    ]
+    assert all(size == 1 for _, size, _ in files)
+    assert first.listed(os.path.join(root, "a", "deep", "2.tif"))
+    first.save()
+
+    # a file added to b, one rewritten in place in a
+    write(os.path.join(root, "b", "5.tif"))
+    write(os.path.join(root, "a", "1.tif"), b"xyz")
+    a = os.path.join(root, "a")
+    b = os.path.join(root, "b")
+    os.utime(a, ns=(0, first._manifest[a]["mtime"]))
+    os.utime(b, ns=(0, first._manifest[b]["mtime"] + 1))
+
+    second = scanner.Scanner(manifest, workers=2)
+    files = {path: size for path, size, _ in second.scan(root)}
+    assert os.path.join(b, "5.tif") in files
+    assert second.listed(os.path.join(b, "5.tif"))
+    # stale until its directory changes, to be restatted
+    assert not second.listed(os.path.join(a, "1.tif"))
+    assert files[os.path.join(a, "1.tif")] == 1
+    assert scanner.restat([os.path.join(a, "1.tif"), os.path.join(a, "gone.tif")]) == [
+        (os.path.join(a, "1.tif"), 3, os.stat(os.path.join(a, "1.tif")).st_mtime_ns)
+    ]
+
+
+def test_corrupt_manifest_is_rebuilt(tmp_path):
+    root = str(tmp_path / "src")
+    write(os.path.join(root, "1.tif"))
+    manifest = tmp_path / "manifest.json"
+    manifest.write_text("{")
+    assert len(scanner.Scanner(str(manifest)).scan(root)) == 1
+
+
+def test_listings(tmp_path):
+    write(str(tmp_path / "1.jpg"), b"abc")
+    os.mkdir(tmp_path / "sub")
+    assert scanner.listdir(str(tmp_path)) == {"1.jpg"}
+    assert scanner.listdir(str(tmp_path / "missing")) == set()
+    assert scanner.liststat(str(tmp_path))["1.jpg"][0] == 3
+    assert scanner.liststat(str(tmp_path / "missing")) == {}
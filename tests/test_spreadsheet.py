@@ -0,0 +1,48 @@
+import importlib
+
+import pandas as pd
+
+spreadsheet = importlib.import_module("imaginerio-etl.utils.spreadsheet")
+
+
+def test_bracketed_headers_survive_a_round_trip(tmp_path):
+    # JSTOR exports xlsx workbooks named .xls
+    path = str(tmp_path / "export.xls")
+    df = pd.DataFrame(
+        {
+            "Title[19462]": ["A", None, "C"],
+            "Width[1604102]": ["10", "20", None],
+            "SSID": ["1", "2", "NEW"],
+        },
+        index=pd.Index(["a", "b", "c"], name="Document ID[19474]"),
+    )
+    spreadsheet.write_excel(df, path, chunksize=2)
+
+    read = spreadsheet.read_excel(path)
+    assert read.columns.to_list() == [
+        "Document ID[19474]",
+        "Title[19462]",
+        "Width[1604102]",
+        "SSID",
+    ]
+    assert read["Document ID[19474]"].to_list() == ["a", "b", "c"]
+    assert read["Title[19462]"].isna().to_list() == [False, True, False]
+    assert read.attrs["headers"] == {
+        "Document ID": "Document ID[19474]",
+        "Title": "Title[19462]",
+        "Width": "Width[1604102]",
+        "SSID": "SSID",
+    }
+
+    # stripped for processing, then written back with JSTOR's headers
+    stripped = read.rename(columns=spreadsheet.strip_id).set_index("Document ID")
+    spreadsheet.write_excel(stripped, path, headers=read.attrs["headers"])
+    assert spreadsheet.read_excel(path).columns.to_list() == read.columns.to_list()
+
+
+def test_strip_id():
+    assert spreadsheet.strip_id("Creator[1603501]") == "Creator"
+    assert spreadsheet.strip_id("Description (Portuguese)") == (
+        "Description (Portuguese)"
+    )
+    assert spreadsheet.strip_id(0) == 0